@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Measure how many posts per second InternalClient.loop_hook delivers to
+the watchers of a thread channel, as the number of watchers grows.
+
+    python bench/broadcast.py [posts per run]
+"""
+
+from collections import deque
+import sys
+import time
+
+from futami.common import (
+    Post,
+    ThreadTarget,
+)
+from futami.external.client import (
+    Client,
+    InternalClient,
+)
+from futami.external.subscription import Subscription
+from futami.ipc import ResponseBatch
+from futami.metrics import Metrics
+
+WATCHER_COUNTS = [1, 10, 100, 1000]
+
+
+class FakeServer:
+    password = None
+    name = 'bench.local'
+    sendq = float('inf')
+
+    def set_write_interest(self, client, interested):
+        pass
+
+    def schedule_disconnect(self, client, quitmsg):
+        pass
+
+
+class FakeSocket:
+    def getpeername(self):
+        return ('127.0.0.1', 6667)
+
+
+class ListQueue(list):
+    def get_batches(self):
+        return [ResponseBatch(time.time(), self)]
+
+
+def make_internal_client():
+    # Skip InternalClient.__init__, which would start the Ami workers
+    internal = InternalClient.__new__(InternalClient)
+    internal.server = FakeServer()
+    internal.nickname = 'control'
+    internal.user = 'ControlUser'
+    internal.host = 'localhost'
+    internal.subscriptions = {}
+    internal.state = None
+    internal.metrics = Metrics()
+    internal.worker_stats = {}
+    internal.streams = deque()
+    internal.unindexed = deque()
+    return internal
+
+
+def make_posts(count):
+    return [
+        Post({
+            'no': 1001 + no,
+            'resto': 1000,
+            'com': '<a href="#p1000" class="quotelink">&gt;&gt;1000</a><br>'
+                   '<span class="quote">&gt;reply {}</span><br>'
+                   'and some more text to go with it'.format(no),
+            'board': 'g',
+        })
+        for no in range(count)
+    ]
+
+
+def run(watcher_count, post_count):
+    internal = make_internal_client()
+    watchers = [Client(FakeServer(), FakeSocket()) for _ in range(watcher_count)]
+    subscription = Subscription(ThreadTarget('g', 1000))
+    subscription.watchers = watchers
+    internal.subscriptions[subscription.target] = subscription
+
+    internal.response_queue = ListQueue(make_posts(post_count))
+
+    started = time.perf_counter()
+    internal.loop_hook()
+    elapsed = time.perf_counter() - started
+
+    delivered = sum(len(watcher._writebuffer) for watcher in watchers)
+    assert delivered == watcher_count * post_count
+    return elapsed
+
+
+def main():
+    post_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    print("{} posts to one thread channel".format(post_count))
+    print("{:>10}{:>14}{:>18}".format('watchers', 'posts/sec', 'lines/sec'))
+    for watcher_count in WATCHER_COUNTS:
+        elapsed = run(watcher_count, post_count)
+        print("{:>10}{:>14.0f}{:>18.0f}".format(
+            watcher_count,
+            post_count / elapsed,
+            post_count * watcher_count / elapsed,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""A fake 4chan API serving synthetic boards that keep getting new posts,
+for benchmarking the bridge without touching the real one.
+
+It serves threads.json, catalog.json and res/<thread>.json for each board
+with Last-Modified headers, and answers If-Modified-Since with 304 Not
+Modified like the real API. Anything else is a 404.
+
+    python bench/fake_api.py [--port 8080] [--boards 10] [--post-rate 20]
+
+and then
+
+    mami-server --api-base http://127.0.0.1:8080 ...
+"""
+
+from email.utils import (
+    formatdate,
+    parsedate_to_datetime,
+)
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+# Boards are named board0, board1, ...
+BOARD_NAME = "board{}"
+THREADS_PER_BOARD = 150
+POSTS_PER_THREAD = 50
+THREADS_PER_PAGE = 15
+
+_path_regexp = re.compile(r"^/(\w+)/(?:(threads|catalog)|res/(\d+))\.json$")
+
+
+def make_comment(no, reply_to):
+    if reply_to:
+        return ('<a href="#p{0}" class="quotelink">&gt;&gt;{0}</a><br>'
+                '<span class="quote">&gt;post {1}</span><br>'
+                'Some more text to go with it.'.format(reply_to, no))
+    return 'Thread <b>{}</b><br>Discuss.'.format(no)
+
+
+class FakeBoards:
+    """Synthetic boards, threads and posts, with new replies arriving at
+    post_rate per second spread at random over every thread.
+    """
+
+    def __init__(self, boards=10, threads=THREADS_PER_BOARD, posts=POSTS_PER_THREAD,
+                 post_rate=10.0):
+        self.post_rate = post_rate
+        self.lock = threading.Lock()
+        self.next_no = 1
+        now = int(time.time())
+
+        # board => {thread_no => [post dicts]}, and thread_no => last_modified
+        self.boards = {}
+        self.last_modified = {}
+        for board_index in range(boards):
+            threads_on_board = {}
+            for _ in range(threads):
+                op = self._make_post(0, now)
+                threads_on_board[op['no']] = [op] + [
+                    self._make_post(op['no'], now) for _ in range(posts - 1)
+                ]
+                self.last_modified[op['no']] = now
+            self.boards[BOARD_NAME.format(board_index)] = threads_on_board
+
+        self.posts_made = 0
+
+    def _make_post(self, reply_to, now):
+        no = self.next_no
+        self.next_no += 1
+        post = {
+            'no': no,
+            'resto': reply_to,
+            'now': time.strftime('%m/%d/%y(%a)%H:%M:%S', time.gmtime(now)),
+            'time': now,
+            'name': 'Anonymous',
+            'com': make_comment(no, reply_to),
+        }
+        if no % 4 == 0:
+            post.update({
+                'filename': 'image{}'.format(no),
+                'ext': '.png',
+                'tim': now * 1000 + no % 1000,
+                'fsize': 123456,
+                'md5': 'e6xzBo+IRnFmLtO6x4xfKg==',
+                'w': 1280, 'h': 720, 'tn_w': 250, 'tn_h': 140,
+            })
+        return post
+
+    def add_post(self):
+        with self.lock:
+            board = random.choice(list(self.boards))
+            thread_no = random.choice(list(self.boards[board]))
+            now = int(time.time())
+            self.boards[board][thread_no].append(self._make_post(thread_no, now))
+            self.last_modified[thread_no] = now
+            self.posts_made += 1
+
+    def run(self):
+        """Keep adding posts at post_rate, forever."""
+        if not self.post_rate:
+            return
+        interval = 1 / self.post_rate
+        next_post = time.monotonic()
+        while True:
+            self.add_post()
+            next_post += interval
+            time.sleep(max(next_post - time.monotonic(), 0))
+
+    def _pages(self, board, describe):
+        threads = sorted(
+            self.boards[board].items(),
+            key=lambda item: self.last_modified[item[0]],
+            reverse=True,
+        )
+        return [
+            {
+                'page': page + 1,
+                'threads': [
+                    describe(no, posts)
+                    for no, posts in threads[page * THREADS_PER_PAGE:(page + 1) * THREADS_PER_PAGE]
+                ],
+            }
+            for page in range((len(threads) + THREADS_PER_PAGE - 1) // THREADS_PER_PAGE)
+        ]
+
+    def document(self, path):
+        """Return the JSON-able document at path and when it last changed,
+        or None if there is no such thing.
+        """
+        m = _path_regexp.match(path)
+        if not m:
+            return None
+        board, listing, thread_no = m.groups()
+
+        with self.lock:
+            if board not in self.boards:
+                return None
+            threads = self.boards[board]
+
+            if listing == 'threads':
+                body = self._pages(board, lambda no, posts: {
+                    'no': no,
+                    'last_modified': self.last_modified[no],
+                })
+            elif listing == 'catalog':
+                body = self._pages(board, lambda no, posts: dict(
+                    posts[0],
+                    replies=len(posts) - 1,
+                    last_modified=self.last_modified[no],
+                    last_replies=posts[-5:],
+                ))
+            else:
+                thread_no = int(thread_no)
+                if thread_no not in threads:
+                    return None
+                return {'posts': list(threads[thread_no])}, self.last_modified[thread_no]
+
+            return body, max(self.last_modified[no] for no in threads)
+
+
+def make_handler(boards):
+    class FakeAPIHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            found = boards.document(self.path)
+            if found is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body, last_modified = found
+
+            since = self.headers.get('If-Modified-Since')
+            if since and parsedate_to_datetime(since).timestamp() >= last_modified:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Last-Modified', formatdate(last_modified, usegmt=True))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return FakeAPIHandler
+
+
+def serve(boards, port, host='127.0.0.1'):
+    """Serve boards and keep posting to them from background threads.
+    Return the HTTP server.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(boards))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=boards.run, daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument('--boards', type=int, default=10, help="number of boards")
+    parser.add_argument('--threads', type=int, default=THREADS_PER_BOARD,
+                        help="threads per board")
+    parser.add_argument('--posts', type=int, default=POSTS_PER_THREAD,
+                        help="posts per thread to start with")
+    parser.add_argument('--post-rate', type=float, default=10.0,
+                        help="new posts per second, over all boards")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    boards = FakeBoards(args.boards, args.threads, args.posts, args.post_rate)
+    serve(boards, args.port)
+    print("Serving {} boards on http://127.0.0.1:{}".format(len(boards.boards), args.port))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Measure how long a large thread load takes to cross from a worker
+process to the IRC server process, sent one post per SimpleQueue put as
+before, and as a single BatchQueue batch.
+
+    python bench/ipc.py [posts per thread]
+"""
+
+import selectors
+import sys
+import time
+
+from futami.common import Post
+from futami.ipc import (
+    BatchQueue,
+    fork_context,
+)
+
+
+def make_posts(count):
+    return [
+        Post({
+            'no': 1000 + no,
+            'resto': 1000 if no else 0,
+            'name': 'Anonymous',
+            'com': 'Reply number {} <br><span class="quote">&gt;implying</span>'.format(no),
+            'board': 'g',
+        })
+        for no in range(count)
+    ]
+
+
+def send_each(queue, posts):
+    for post in posts:
+        queue.put(post)
+
+
+def send_batch(queue, posts):
+    queue.put(posts)
+
+
+def receive_each(queue, count):
+    received = 0
+    while received < count:
+        queue._reader.poll(None)
+        while not queue.empty():
+            queue.get()
+            received += 1
+
+
+def receive_batches(queue, count):
+    selector = selectors.DefaultSelector()
+    selector.register(queue, selectors.EVENT_READ)
+    received = 0
+    while received < count:
+        selector.select()
+        for batch in queue.get_batches():
+            received += len(batch.items)
+
+
+def run(queue, send, receive, count):
+    posts = make_posts(count)
+    started = time.perf_counter()
+    worker = fork_context.Process(target=send, args=(queue, posts))
+    worker.start()
+    receive(queue, count)
+    elapsed = time.perf_counter() - started
+    worker.join()
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    print("{} posts from one worker".format(count))
+    print("{:<14}{:>14}{:>14}".format('', 'seconds', 'posts/sec'))
+    for name, queue, send, receive in [
+        ('SimpleQueue', fork_context.SimpleQueue(), send_each, receive_each),
+        ('BatchQueue', BatchQueue(), send_batch, receive_batches),
+    ]:
+        elapsed = run(queue, send, receive, count)
+        print("{:<14}{:>14.3f}{:>14.0f}".format(name, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""Run mami-server against the fake API in bench/fake_api.py with a number
+of IRC clients joined to its boards and threads, and report how it copes.
+
+    python bench/load.py [--clients 50] [--duration 60] [-- server options]
+
+Reported are how long each channel took from JOIN to its first post, the
+posts and lines per second delivered to clients, and the CPU time and
+resident memory of the server and its API workers. Options after -- are
+passed to mami-server, e.g. -- --engine asyncio --api-workers 4.
+"""
+
+from collections import defaultdict
+import argparse
+import os
+import random
+import re
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+import fake_api
+
+_post_regexp = re.compile(r"^:/\w+/(\d+)!\S+ PRIVMSG (\S+) :")
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class LoadClient:
+    """One IRC connection, joined to some channels, counting the posts
+    that come in on each.
+    """
+
+    def __init__(self, number, port, channels):
+        self.nickname = "load{}".format(number)
+        self.channels = channels
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.setblocking(False)
+        self._readbuffer = b""
+
+        self.joined_at = {}
+        self.first_post_at = {}
+        self.lines = 0
+        self.posts = set()
+
+        self.send("NICK {0}\r\nUSER {0} * * {0}".format(self.nickname))
+
+    def send(self, line):
+        self.socket.sendall((line + "\r\n").encode('utf-8'))
+
+    def join(self):
+        for channel in self.channels:
+            self.joined_at[channel] = time.monotonic()
+            self.send("JOIN {}".format(channel))
+
+    def readable(self):
+        data = self.socket.recv(2 ** 16)
+        if not data:
+            raise EOFError("{} was disconnected".format(self.nickname))
+        now = time.monotonic()
+
+        lines = (self._readbuffer + data).split(b"\r\n")
+        self._readbuffer = lines.pop()
+        for line in lines:
+            line = line.decode('utf-8', 'replace')
+            if line.startswith("PING"):
+                self.send("PONG" + line[4:])
+                continue
+
+            m = _post_regexp.match(line)
+            if not m:
+                continue
+            post_no, channel = m.groups()
+            self.first_post_at.setdefault(channel, now)
+            self.lines += 1
+            self.posts.add(int(post_no))
+
+
+def process_tree(pid):
+    """Return pid and the pids of all its descendants."""
+    children = defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        children[int(fields[1])].append(int(entry))
+
+    pids = [pid]
+    for parent in pids:
+        pids.extend(children[parent])
+    return pids
+
+
+def resource_usage(pid):
+    """Return the CPU seconds used so far, and the resident memory in bytes,
+    of a process and all its descendants.
+    """
+    cpu = 0
+    rss = 0
+    for each in process_tree(pid):
+        try:
+            with open('/proc/{}/stat'.format(each)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # utime, stime and rss, counted from the field after the name
+        cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        rss += int(fields[21]) * PAGE_SIZE
+    return cpu, rss
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server didn't start listening on port {}".format(port))
+
+
+def pick_channels(boards, threads_per_client, rng):
+    board = rng.choice(list(boards.boards))
+    thread_nos = rng.sample(list(boards.boards[board]), threads_per_client)
+    return ["#/{}/".format(board)] + ["#/{}/{}".format(board, no) for no in thread_nos]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    argv = sys.argv[1:]
+    server_args = []
+    if '--' in argv:
+        server_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--threads-per-client', type=int, default=3,
+                        help="threads each client joins, besides its board")
+    parser.add_argument('--duration', type=float, default=60,
+                        help="seconds to measure for once every client has joined")
+    parser.add_argument('--irc-port', type=int, default=16667)
+    parser.add_argument('--api-port', type=int, default=18080)
+    parser.add_argument('--seed', type=int, default=0)
+    fake_api.add_arguments(parser)
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+
+    boards = fake_api.FakeBoards(args.boards, args.threads, args.posts, args.post_rate)
+    fake_api.serve(boards, args.api_port)
+
+    server = subprocess.Popen([
+        sys.executable, '-m', 'futami.mami',
+        '--ports', str(args.irc_port),
+        '--api-base', 'http://127.0.0.1:{}'.format(args.api_port),
+        # The fake API can take it
+        '--api-rate', '1000',
+        '--api-burst', '1000',
+    ] + server_args, stderr=subprocess.DEVNULL)
+
+    try:
+        wait_for_port(args.irc_port)
+        cpu_before, _ = resource_usage(server.pid)
+
+        clients = [
+            LoadClient(number, args.irc_port, pick_channels(boards, args.threads_per_client, rng))
+            for number in range(args.clients)
+        ]
+        selector = selectors.DefaultSelector()
+        for client in clients:
+            selector.register(client.socket, selectors.EVENT_READ, client)
+            client.join()
+
+        started = time.monotonic()
+        posts_made_before = boards.posts_made
+        peak_rss = 0
+        next_sample = started
+        while time.monotonic() < started + args.duration:
+            for key, _ in selector.select(timeout=0.5):
+                key.data.readable()
+            if time.monotonic() >= next_sample:
+                peak_rss = max(peak_rss, resource_usage(server.pid)[1])
+                next_sample += 1
+
+        elapsed = time.monotonic() - started
+        cpu_after, rss = resource_usage(server.pid)
+    finally:
+        for pid in reversed(process_tree(server.pid)):
+            try:
+                os.kill(pid, 15)
+            except OSError:
+                pass
+
+    latencies = [
+        client.first_post_at[channel] - client.joined_at[channel]
+        for client in clients
+        for channel in client.first_post_at
+    ]
+    joined = sum(len(client.channels) for client in clients)
+    lines = sum(client.lines for client in clients)
+    posts = set().union(*(client.posts for client in clients))
+
+    print("{} clients in {} channels over {:.0f}s, server options: {}".format(
+        args.clients, joined, elapsed, ' '.join(server_args) or '(defaults)'))
+    print("fake API made {} new posts".format(boards.posts_made - posts_made_before))
+    print()
+    if latencies:
+        print("join to first post   median {:.3f}s  p90 {:.3f}s  max {:.3f}s  ({} of {} channels)".format(
+            percentile(latencies, 0.5), percentile(latencies, 0.9), max(latencies),
+            len(latencies), joined))
+    else:
+        print("join to first post   no channel got a post")
+    print("delivered            {:.1f} posts/s, {:.1f} lines/s".format(
+        len(posts) / elapsed, lines / elapsed))
+    print("server CPU           {:.1f}s ({:.0f}% of one core)".format(
+        cpu_after - cpu_before, 100 * (cpu_after - cpu_before) / elapsed))
+    print("server RSS           {:.1f} MiB at the end, {:.1f} MiB peak".format(
+        rss / 2 ** 20, max(peak_rss, rss) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
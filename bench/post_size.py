@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Compare the memory and pickle size of Post against the original
+dict-backed implementation, which is reproduced here as LegacyPost.
+
+    python bench/post_size.py [number of posts]
+"""
+
+import pickle
+import sys
+import tracemalloc
+
+from futami.common import (
+    Image,
+    Post,
+)
+
+
+class LegacyPost:
+    post_fields = [
+        'no', 'resto', 'sticky', 'closed', 'now', 'time', 'name', 'trip',
+        'filename', 'id', 'capcode', 'country', 'country_name', 'email', 'sub',
+        'com', 'tim', 'ext', 'fsize', 'md5', 'w', 'h', 'tn_w', 'tn_h',
+        'filedeleted', 'spoiler', 'custom_spoiler', 'omitted_posts',
+        'omitted_images', 'replies', 'images', 'bumplimit', 'imagelimit',
+        'capcode_replies', 'last_modified', 'tag', 'semantic_url',
+        'unique_ips', 'board',
+    ]
+
+    def __init__(self, data):
+        missing_fields = set(self.post_fields).difference(data.keys())
+        data.update({field: None for field in missing_fields})
+        self.data = data
+        self._image = Image(*(data[field] for field in Image._fields))
+
+
+def make_post_data(no, with_image):
+    data = {
+        'no': no,
+        'resto': 1000,
+        'now': '01/01/15(Thu)00:00:00',
+        'time': 1420070400,
+        'name': 'Anonymous',
+        'com': 'Reply number {} <br><span class="quote">&gt;implying</span>'.format(no),
+        'replies': 0,
+        'images': 0,
+        'board': 'g',
+    }
+    if with_image:
+        data.update({
+            'filename': 'image{}'.format(no),
+            'tim': 1420070400000 + no,
+            'ext': '.png',
+            'fsize': 123456,
+            'md5': 'e6xzBo+IRnFmLtO6x4xfKg==',
+            'w': 1920,
+            'h': 1080,
+            'tn_w': 250,
+            'tn_h': 140,
+        })
+    return data
+
+
+def measure(cls, count):
+    # The decoded JSON is counted too, since a post may keep it alive
+    tracemalloc.start()
+    datas = [make_post_data(no, no % 3 == 0) for no in range(count)]
+    posts = [cls(data) for data in datas]
+    del datas
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    pickled = sum(len(pickle.dumps(post)) for post in posts)
+    return memory, pickled
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    print("{} posts, one in three with an image".format(count))
+    print("{:<12}{:>16}{:>16}".format('', 'bytes/post', 'pickled/post'))
+    for cls in (LegacyPost, Post):
+        memory, pickled = measure(cls, count)
+        print("{:<12}{:>16.0f}{:>16.0f}".format(
+            cls.__name__, memory / count, pickled / count,
+        ))
+
+
+if __name__ == '__main__':
+    main()
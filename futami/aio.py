@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""An Ami that runs on a single asyncio event loop, with non-blocking HTTP
+through aiohttp, instead of a pair of processes making blocking requests.
+
+Install with the asyncio extra to use it, and select it with
+mami-server --engine asyncio.
+"""
+
+from functools import wraps
+from itertools import count
+from multiprocessing import current_process
+from operator import itemgetter
+from time import (
+    monotonic,
+    time,
+)
+import asyncio
+import logging
+import traceback
+
+import aiohttp
+
+from futami import fetch
+from futami.ami import (
+    API_BASE,
+    GONE,
+    RETRY_ATTEMPTS,
+    RETRY_BASE_WAIT,
+    RETRY_MAX_WAIT,
+    STATS_INTERVAL,
+    PollScheduler,
+    SeenState,
+    ThreadIndex,
+    ThreadListing,
+    board_document,
+    catalog_document,
+    flatten,
+    is_archived,
+    thread_document,
+)
+from futami.common import (
+    Action,
+    BoardTarget,
+    LoadFailed,
+    Post,
+    StoredException,
+    SubscriptionUpdate,
+    TargetGone,
+    ThreadTarget,
+    WorkerStats,
+)
+from futami.fetch import (
+    CONNECT_TIMEOUT,
+    READ_TIMEOUT,
+    BaseFetcher,
+    fetch_stats,
+    is_gone,
+)
+
+# Upper bound on API connections open at once from one worker
+MAX_CONNECTIONS = 16
+
+# Everything a fetch can fail with once its retries are exhausted
+FETCH_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def is_transient(exception):
+    """Like futami.fetch.is_transient, for fetches made with aiohttp."""
+    return fetch.is_transient(exception, FETCH_ERRORS)
+
+
+def api_retry(f):
+    """Retry a coroutine on transient failures, backing off the same way
+    futami.ami.api_retry does.
+    """
+    @wraps(f)
+    async def wrapper(*args, **kwargs):
+        for attempt in count(1):
+            try:
+                return await f(*args, **kwargs)
+            except FETCH_ERRORS as ex:
+                if attempt >= RETRY_ATTEMPTS or not is_transient(ex):
+                    raise
+                wait = min(RETRY_BASE_WAIT * 2 ** attempt, RETRY_MAX_WAIT)
+                await asyncio.sleep(wait / 1000)
+    return wrapper
+
+
+class AsyncFetcher(BaseFetcher):
+    """Fetches JSON documents from the 4chan API without blocking. It does
+    all that futami.fetch.Fetcher does, with an aiohttp session.
+
+    It must be made from within a running event loop.
+    """
+
+    def __init__(self, session, rate_limiter=None, interactive=False):
+        super().__init__(rate_limiter, interactive)
+        self.session = session
+
+    async def acquire(self):
+        started = monotonic()
+        with self.rate_limiter.waiting(self.interactive):
+            wait = self.rate_limiter.take(self.interactive)
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self.rate_limiter.take(self.interactive)
+        return monotonic() - started
+
+    async def get_json(self, url, conditional=False):
+        """Return the decoded JSON at url. When conditional is set and the
+        resource is unchanged since it was last fetched, return None.
+        """
+        headers = self.request_headers(url, conditional)
+        if self.rate_limiter:
+            self.waited(await self.acquire())
+
+        started = monotonic()
+        async with self.session.get(url, headers=headers) as response:
+            if self.received(url, response.status, started):
+                return None
+
+            response.raise_for_status()
+            body = await response.read()
+
+        return self.store(url, response.headers, body)
+
+
+class AsyncAmi:
+    """Takes the same requests as Ami and sends back the same results, but
+    loads and follows every target as coroutines on one event loop in the
+    process it is started in.
+    """
+
+    def __init__(self, request_queue, response_queue, rate_limiter=None, shard=0,
+                 api_base=API_BASE):
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        self.rate_limiter = rate_limiter
+        self.api_base = api_base
+
+        # Tasks that are running
+        self._tasks = set()
+
+        logger.debug("initialization complete")
+
+        try:
+            asyncio.run(self.run())
+        except Exception:
+            self.response_queue.put([StoredException(traceback.format_exc(), current_process().name)])
+
+    async def run(self):
+        self.update_request_queue = asyncio.Queue()
+        # Set whenever update_loop has something to do before its next poll
+        self._wakeup = asyncio.Event()
+        # Set to the exception of the first task to fail, or to None on
+        # shutdown
+        self._failure = asyncio.get_running_loop().create_future()
+
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+        timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            # Initial loads have a user waiting on them, so they get priority
+            self.fetcher = AsyncFetcher(
+                session,
+                rate_limiter=self.rate_limiter,
+                interactive=True,
+            )
+            self.background_fetcher = AsyncFetcher(
+                session,
+                rate_limiter=self.rate_limiter,
+            )
+
+            self.spawn(self.request_loop())
+            self.spawn(self.update_loop(self.response_queue, self.update_request_queue))
+
+            # Exceptions in any task bring the whole worker down
+            await self._failure
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if task.cancelled() or self._failure.done():
+            return
+        if task.exception() is not None:
+            self._failure.set_exception(task.exception())
+
+    # Loop to handle fast part of LoadAndFollow and other requests from IRC
+    async def request_loop(self):
+        readable = asyncio.Event()
+        asyncio.get_running_loop().add_reader(self.request_queue._reader.fileno(), readable.set)
+
+        while True:
+            await readable.wait()
+            readable.clear()
+
+            while self.request_queue._reader.poll():
+                request = self.request_queue.get()
+                logger.debug("Got request {}".format(request))
+
+                if request.action is Action.LoadAndFollow:
+                    self.spawn(self.load_and_follow(request))
+                elif request.action is Action.Resume:
+                    # Nothing to load, so hand it straight to update_loop
+                    self.follow(request.target, request.payload)
+                elif request.action is Action.Stop:
+                    self.update_request_queue.put_nowait(request)
+                    self._wakeup.set()
+                elif request.action is Action.Shutdown:
+                    logger.info("shutting down")
+                    if not self._failure.done():
+                        self._failure.set_result(None)
+                    return
+
+    def follow(self, target, seen):
+        self.update_request_queue.put_nowait(SubscriptionUpdate.make(
+            action=Action.InternalQueueUpdate,
+            target=target,
+            payload=seen,
+        ))
+        self._wakeup.set()
+
+    async def load_and_follow(self, request):
+        try:
+            if isinstance(request.target, BoardTarget):
+                threads = await self.get_catalog(request.target.board)
+
+                # Seed the seen state so update_loop doesn't re-fetch them
+                self.follow(
+                    request.target,
+                    {thread['no']: thread['last_modified'] for thread in threads},
+                )
+
+                threads.sort(key=itemgetter('last_modified'))
+                posts = [Post(thread) for thread in threads]
+
+            elif isinstance(request.target, ThreadTarget):
+                posts = await self.get_thread(request.target.board, request.target.thread)
+
+                self.follow(request.target, max(post.post_no for post in posts))
+
+        except FETCH_ERRORS as ex:
+            logger.exception("Giving up on request {}".format(request))
+            self.response_queue.put([LoadFailed(request.target, is_gone(ex))])
+            return
+
+        for post in posts:
+            post.payload = request.payload
+
+        self.response_queue.put(posts)
+
+    # The get_* methods return None instead of a result when asked for a
+    # conditional fetch of something that hasn't changed since last time.
+    # Conditional fetches are the background ones.
+
+    async def fetch(self, document, conditional):
+        fetcher = self.background_fetcher if conditional else self.fetcher
+        data = await fetcher.get_json(document.url, conditional)
+        if data is None:
+            return None
+        return document.parse(data)
+
+    @api_retry
+    async def get_board(self, board, conditional=False):
+        return await self.fetch(board_document(self.api_base, board), conditional)
+
+    @api_retry
+    async def get_catalog(self, board, conditional=False):
+        return await self.fetch(catalog_document(self.api_base, board), conditional)
+
+    @api_retry
+    async def get_thread(self, board, thread, conditional=False):
+        return await self.fetch(thread_document(self.api_base, board, thread), conditional)
+
+    async def poll(self, target):
+        """Conditionally fetch a target, or a board listing. Failures are
+        logged and, like an unchanged result, come back as None, except for
+        a 404, which comes back as GONE.
+        """
+        try:
+            if isinstance(target, BoardTarget):
+                return await self.get_catalog(target.board, conditional=True)
+            if isinstance(target, ThreadListing):
+                return await self.get_board(target.board, conditional=True)
+            return await self.get_thread(target.board, target.thread, conditional=True)
+        except FETCH_ERRORS as ex:
+            if is_gone(ex):
+                logger.info("{} is gone".format(target))
+                return GONE
+            logger.exception("Failed to poll {}".format(target))
+            return None
+
+    # Timed loop to hit 4chan API
+    async def update_loop(self, response_queue, update_request_queue):
+        # Boards are polled through their catalogs, and threads through
+        # the listings of their boards
+        scheduler = PollScheduler()
+        seen = SeenState()
+        index = ThreadIndex()
+        # New posts from polls that have finished since the last batch
+        batch = []
+        next_stats = time()
+
+        def unfollow(target):
+            seen.forget(target)
+            if isinstance(target, BoardTarget):
+                scheduler.remove(target)
+            elif index.drop(target):
+                scheduler.remove(ThreadListing(target.board))
+
+        def gone(target):
+            logger.info("{} is gone, no longer following it".format(target))
+            unfollow(target)
+            batch.append(TargetGone(target))
+
+        async def poll_thread(thread, last_modified):
+            result = await self.poll(thread)
+            if result is GONE:
+                gone(thread)
+                return []
+            if result is None:
+                return []
+            if last_modified is not None:
+                index.fetched(thread, last_modified)
+            new = seen.update(thread, result)
+            if is_archived(result):
+                # Its last posts go out before the notice
+                batch.extend(new)
+                gone(thread)
+                return []
+            return new
+
+        async def poll(target):
+            result = await self.poll(target)
+            if target not in scheduler:
+                # Stopped while the poll was in flight
+                return
+
+            if isinstance(target, ThreadListing):
+                # Nothing is left on a board that is gone
+                changed, missing = index.update(target.board, [] if result is GONE else result)
+                changed.extend((thread, None) for thread in missing)
+                new = list(flatten(await asyncio.gather(*[
+                    poll_thread(thread, last_modified) for thread, last_modified in changed
+                ])))
+            elif result is GONE:
+                gone(target)
+                return
+            else:
+                new = [] if result is None else seen.update(target, result)
+
+            batch.extend(new)
+            # Unless it has just gone
+            if target in scheduler:
+                scheduler.reschedule(target, bool(new), time())
+            self._wakeup.set()
+
+        while True:
+            while not update_request_queue.empty():
+                request = update_request_queue.get_nowait()
+                if request.action is Action.InternalQueueUpdate:
+                    target = request.target
+                    seen.merge(target, request.payload)
+                    if isinstance(target, ThreadTarget):
+                        index.follow(target)
+                        target = ThreadListing(target.board)
+                    scheduler.add(target, time())
+                elif request.action is Action.Stop:
+                    logger.info("no longer following {}".format(request.target))
+                    unfollow(request.target)
+
+            # Every due target is polled on its own, so one slow fetch holds
+            # up nothing else. A target isn't due again until its poll has
+            # finished, so posts of a thread still go out in order.
+            due = scheduler.pop_due(time())
+            for target in due:
+                self.spawn(poll(target))
+
+            if (batch or due) and time() >= next_stats:
+                batch.append(WorkerStats(current_process().name, dict(
+                    fetch_stats(self.background_fetcher),
+                    targets=len(scheduler),
+                    threads=sum(map(len, index.followed.values())),
+                    initial_loads=fetch_stats(self.fetcher),
+                )))
+                next_stats = time() + STATS_INTERVAL
+
+            if batch:
+                response_queue.put(batch)
+                batch = []
+
+            # Sleep until the next poll is due, waking early for new targets
+            # and finished polls
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), scheduler.time_until_next(time()))
+            except asyncio.TimeoutError:
+                pass
@@ -1,35 +1,84 @@
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
-from itertools import chain
-from functools import wraps
+from collections import (
+    defaultdict,
+    namedtuple,
+)
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+from itertools import (
+    chain,
+    count,
+)
+from functools import (
+    partial,
+    wraps,
+)
 from operator import itemgetter
 from multiprocessing import (
+    connection,
     current_process,
-    SimpleQueue,
-    Process,
 )
-from time import sleep
+from time import time
+import heapq
 import logging
+import os
 import sys
 import traceback
 
 from retrying import retry
-import requests
 
 from futami.common import (
     Action,
     BoardTarget,
+    LoadFailed,
     SubscriptionUpdate,
     StoredException,
     Post,
+    TargetGone,
     ThreadTarget,
+    WorkerStats,
 )
+from futami.fetch import (
+    FETCH_ERRORS,
+    Fetcher,
+    fetch_stats,
+    is_gone,
+    is_transient,
+)
+from futami.ipc import fork_context
 
+# Targets are polled every SLEEP_TIME seconds while they are active. Each
+# poll that turns up nothing new multiplies a target's interval by
+# POLL_BACKOFF, up to MAX_SLEEP_TIME, and new posts reset it again.
 SLEEP_TIME = 3  # seconds
+MAX_SLEEP_TIME = 120  # seconds
+POLL_BACKOFF = 1.5
+
+# Upper bound on API requests in flight at once from the periodic worker
+MAX_CONCURRENT_FETCHES = 8
+
+# The periodic worker sends back its statistics at most this often
+STATS_INTERVAL = 10  # seconds
 
-THREAD_LIST = "https://a.4cdn.org/{board}/threads.json"
-THREAD = "https://a.4cdn.org/{board}/res/{thread}.json"
+# Retried fetches back off exponentially from RETRY_BASE_WAIT, doubling up
+# to RETRY_MAX_WAIT between attempts, and give up after RETRY_ATTEMPTS.
+RETRY_ATTEMPTS = 5
+RETRY_BASE_WAIT = 500  # milliseconds
+RETRY_MAX_WAIT = 8000  # milliseconds
+
+# Endpoints are relative to the API base, which can be pointed elsewhere,
+# e.g. at the fake API in bench/fake_api.py
+API_BASE = "https://a.4cdn.org"
+THREAD_LIST = "/{board}/threads.json"
+CATALOG = "/{board}/catalog.json"
+THREAD = "/{board}/res/{thread}.json"
+
+# What a poll comes back with when its target is gone from the API
+GONE = object()
 
 
 logger = logging.getLogger(__name__)
@@ -39,22 +88,334 @@ def flatten(lst):
     return chain.from_iterable(lst)
 
 
+api_retry = retry(
+    retry_on_exception=is_transient,
+    stop_max_attempt_number=RETRY_ATTEMPTS,
+    wait_exponential_multiplier=RETRY_BASE_WAIT,
+    wait_exponential_max=RETRY_MAX_WAIT,
+)
+
+
+def listed_threads(pages):
+    """Return every thread in a board's threads.json, as dicts of its no
+    and last_modified.
+    """
+    return list(flatten([page['threads'] for page in pages]))
+
+
+def catalog_threads(pages, board):
+    """Return the OP of every thread in a board's catalog as post dicts,
+    each also carrying the thread's last_modified.
+    """
+    threads = list(flatten([page['threads'] for page in pages]))
+
+    for thread in threads:
+        # Replies are picked up by thread watchers, not from here
+        thread.pop('last_replies', None)
+        thread['board'] = board
+
+    return threads
+
+
+def thread_posts(thread, board):
+    posts = thread['posts']
+
+    for post in posts:
+        post['board'] = board
+
+    return list(map(Post, posts))
+
+
+def is_archived(posts):
+    """Whether the posts of a thread are those of an archived one, which
+    takes no more replies.
+    """
+    return bool(posts) and bool(posts[0].archived)
+
+
+# An API document to fetch, and what turns it into the result of the get_*
+# method it is fetched for. Only the fetching differs between engines.
+ApiDocument = namedtuple('ApiDocument', ['url', 'parse'])
+
+
+def board_document(api_base, board):
+    return ApiDocument(api_base + THREAD_LIST.format(board=board), listed_threads)
+
+
+def catalog_document(api_base, board):
+    return ApiDocument(
+        api_base + CATALOG.format(board=board),
+        partial(catalog_threads, board=board),
+    )
+
+
+def thread_document(api_base, board, thread):
+    return ApiDocument(
+        api_base + THREAD.format(board=board, thread=thread),
+        partial(thread_posts, board=board),
+    )
+
+
+class ThreadListing(namedtuple('ThreadListing', ['board'])):
+    """Scheduler key for a board's threads.json, which is polled on behalf
+    of the threads followed on that board. Unlike a tuple, it is never
+    equal to a BoardTarget of the same board.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(other) is ThreadListing and tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((ThreadListing, self.board))
+
+
+class ThreadIndex:
+    """Followed threads, grouped by board, with the last_modified each was
+    last fetched at.
+
+    A board's threads.json lists the last_modified of every thread still on
+    the board, so one cheap conditional fetch of it tells which followed
+    threads have changed and need fetching in full, and which are missing
+    and need fetching to tell whether they have been archived or pruned.
+    """
+
+    def __init__(self):
+        # Dictionary of board => {thread_no => last_modified fetched at}
+        self.followed = {}
+        # Dictionary of board => {thread_no => last_modified} of the last
+        # listing fetched
+        self.listings = {}
+
+    def follow(self, target):
+        """Start following a thread. It is fetched on the next listing
+        that shows it.
+        """
+        self.followed.setdefault(target.board, {}).setdefault(target.thread, 0)
+
+    def drop(self, target):
+        """Stop following a thread. Return whether it was the last one
+        followed on its board.
+        """
+        threads = self.followed.get(target.board, {})
+        threads.pop(target.thread, None)
+        if threads:
+            return False
+        self.followed.pop(target.board, None)
+        self.listings.pop(target.board, None)
+        return True
+
+    def update(self, board, threads):
+        """Take in a board listing, or None if it is unchanged since the
+        last one. Return the followed threads that have changed since they
+        were fetched, as (ThreadTarget, last_modified) pairs to hand to
+        fetched once they have been, and those missing from the listing.
+
+        The API may serve a listing from before a change, so a missing
+        thread may be gone, or too new to be listed yet. Only fetching it
+        tells which.
+        """
+        if threads is not None:
+            self.listings[board] = {
+                thread['no']: thread['last_modified'] for thread in threads
+            }
+        listing = self.listings.get(board)
+        if listing is None:
+            return [], []
+
+        changed = []
+        missing = []
+        followed = self.followed.get(board, {})
+        for thread_no, fetched in followed.items():
+            last_modified = listing.get(thread_no)
+            if last_modified is None:
+                # A thread followed since the last fresh listing may just
+                # be missing from an old one
+                if threads is not None:
+                    missing.append(ThreadTarget(board, thread_no))
+            elif last_modified > fetched:
+                changed.append((ThreadTarget(board, thread_no), last_modified))
+        return changed, missing
+
+    def fetched(self, target, last_modified):
+        """Record that a thread has been fetched since it changed at
+        last_modified. Until then, every listing shows it as changed.
+        """
+        threads = self.followed.get(target.board, {})
+        if target.thread in threads:
+            threads[target.thread] = max(threads[target.thread], last_modified)
+
+
+class SeenState:
+    """What has already been sent for each followed target, so that each
+    poll only sends what is new.
+    """
+
+    def __init__(self):
+        # Dictionary of board => {thread_no => last_modified} last seen on board
+        self.boards = defaultdict(dict)
+        # Dictionary of board, thread => highest post number seen on thread.
+        # Post numbers only ever increase within a thread, so anything above
+        # the watermark is new.
+        self.threads = defaultdict(dict)
+
+    def merge(self, target, payload):
+        """Take in the seen state of an InternalQueueUpdate. Merge rather
+        than overwrite, in case the target was already being followed.
+        """
+        if isinstance(target, BoardTarget):
+            self.boards[target.board].update(payload)
+        elif isinstance(target, ThreadTarget):
+            board, thread_no = target
+            self.threads[board][thread_no] = max(
+                payload,
+                self.threads[board].get(thread_no, 0),
+            )
+
+    def forget(self, target):
+        """Drop the seen state of a target that is no longer followed."""
+        if isinstance(target, BoardTarget):
+            self.boards.pop(target.board, None)
+        else:
+            self.threads[target.board].pop(target.thread, None)
+
+    def update(self, target, result):
+        """Return the posts in a poll result that haven't been sent yet,
+        and remember them as sent.
+        """
+        new = []
+
+        if isinstance(target, BoardTarget):
+            board = target.board
+            seen_threads_on_board = {}
+            for thread in result:
+                thread_no = thread['no']
+                last_modified = thread['last_modified']
+                if thread_no not in self.boards[board]:
+                    op = Post(thread)
+                    logger.debug("sending new thread {}".format(op))
+                    new.append(op)
+                elif last_modified > self.boards[board][thread_no]:
+                    op = Post(thread)
+                    logger.debug("sending updated thread {}".format(op))
+                    new.append(op)
+                elif last_modified < self.boards[board][thread_no]:
+                    # Sometimes we get stale data immediately after reading
+                    # it (tested under SLEEP_TIME = 3). Ignore this data.
+                    continue
+                seen_threads_on_board[thread_no] = last_modified
+
+            self.boards[board] = seen_threads_on_board
+
+        else:
+            board, thread_no = target
+            watermark = self.threads[board].get(thread_no, 0)
+            for post in result:
+                if post.post_no > watermark:
+                    logger.debug("sending new post {}".format(post))
+                    new.append(post)
+                    watermark = post.post_no
+
+            self.threads[board][thread_no] = watermark
+
+        return new
+
+
+class PollScheduler:
+    """Keeps watched targets in a heap ordered by when they are next due
+    to be polled, each with its own adaptive poll interval.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # Dictionary of target => (sequence number of its live heap entry,
+        # current interval). Heap entries with any other sequence number
+        # have been superseded and are skipped.
+        self._entries = {}
+        self._sequence = count()
+
+    def __contains__(self, target):
+        return target in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _push(self, target, interval, now):
+        sequence = next(self._sequence)
+        self._entries[target] = (sequence, interval)
+        heapq.heappush(self._heap, (now + interval, sequence, target))
+
+    def add(self, target, now):
+        """Start polling target, or poll it sooner if already watched."""
+        self._push(target, SLEEP_TIME, now)
+
+    def remove(self, target):
+        """Stop polling target."""
+        self._entries.pop(target, None)
+
+    def pop_due(self, now):
+        """Remove and return every target whose poll is due."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, sequence, target = heapq.heappop(self._heap)
+            if self._entries.get(target, (None,))[0] == sequence:
+                due.append(target)
+        return due
+
+    def reschedule(self, target, changed, now):
+        """Schedule the next poll of a target that was just polled."""
+        _, interval = self._entries[target]
+        if changed:
+            interval = SLEEP_TIME
+        else:
+            interval = min(interval * POLL_BACKOFF, MAX_SLEEP_TIME)
+        self._push(target, interval, now)
+
+    def time_until_next(self, now):
+        """Seconds until the next poll is due, or None if nothing is watched."""
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - now, 0)
+
+
 class Ami:
-    def __init__(self, request_queue, response_queue):
+    def __init__(self, request_queue, response_queue, rate_limiter=None, shard=0,
+                 api_base=API_BASE):
         self.request_queue = request_queue
         self.response_queue = response_queue
-        self.update_request_queue = SimpleQueue()
-
-        Process(
+        self.update_request_queue = fork_context.SimpleQueue()
+        self.rate_limiter = rate_limiter
+        self.api_base = api_base
+        # Initial loads have a user waiting on them, so they get priority.
+        # They are only asked for targets nobody follows yet, as rejoins are
+        # served from their subscription's snapshot and scrollback, so
+        # there is nothing for them to reuse from earlier fetches.
+        self.fetcher = Fetcher(
+            rate_limiter=rate_limiter,
+            interactive=True,
+        )
+
+        self.periodic = fork_context.Process(
             target=self.update_loop,
-            name='periodic api worker',
+            name='periodic api worker {}'.format(shard),
             args=(response_queue, self.update_request_queue),
-        ).start()
+        )
+        self.periodic.start()
 
         logger.debug("initialization complete")
 
         self.request_loop()
 
+        # However that ended, stop the periodic worker too. A process only
+        # exits once its children have.
+        self.update_request_queue.put(SubscriptionUpdate.make(
+            action=Action.Shutdown,
+            target=None,
+        ))
+
     def proxy_exception_to(instance_attribute_exception_proxy_queue):
         def _proxy_exception(f):
             """This isn't your normal-looking function.
@@ -67,7 +428,7 @@ class Ami:
                     queue = getattr(self, instance_attribute_exception_proxy_queue)
                     tb = traceback.format_exc()
                     this_process = current_process()
-                    queue.put(StoredException(tb, this_process.name))
+                    queue.put([StoredException(tb, this_process.name)])
             return wrapper
         return _proxy_exception
 
@@ -77,136 +438,256 @@ class Ami:
         # The identifier argument is an opaque
         # identifier used by the queue client in some situations.
         while True:
+            # A worker whose periodic worker has died, however it died,
+            # exits too, so that its targets are moved to the others
+            ready = connection.wait([self.request_queue._reader, self.periodic.sentinel])
+            if self.periodic.sentinel in ready:
+                logger.error("periodic api worker has exited, stopping")
+                return
+
             request = self.request_queue.get()
             logger.debug("Got request {}".format(request))
 
-            if request.action is Action.LoadAndFollow:
-                if isinstance(request.target, BoardTarget):
-                    # Download all threads
-                    board = request.target.board
-                    threads = self.get_board(board)
-
-                    # Seed seen_boards so update_loop doesn't re-fetch them
-                    self.update_request_queue.put(SubscriptionUpdate.make(
-                        action=Action.InternalQueueUpdate,
-                        target=request.target,
-                        payload={thread['no']: thread['last_modified'] for thread in threads},
-                    ))
-
-                    threads.sort(key=itemgetter('last_modified'))
-
-                    # Download all thread content so we can get the OP
-                    for thread in threads:
-                        posts = list(self.get_thread(board, thread['no']))
-                        op = posts[0]
-                        op.payload = request.payload
-
-                        self.response_queue.put(op)
-
-                elif isinstance(request.target, ThreadTarget):
-                    posts = list(self.get_thread(
-                        request.target.board,
-                        request.target.thread
-                    ))
+            if request.action is Action.Shutdown:
+                logger.info("shutting down")
+                return
 
+            try:
+                if request.action is Action.LoadAndFollow:
+                    self.load_and_follow(request)
+                elif request.action is Action.Resume:
+                    # Nothing to load, so hand it straight to update_loop
                     self.update_request_queue.put(SubscriptionUpdate.make(
                         action=Action.InternalQueueUpdate,
                         target=request.target,
-                        payload=posts,
+                        payload=request.payload,
                     ))
-
-                    for post in posts:
-                        post.payload = request.payload
-
-                        self.response_queue.put(post)
-
-    @retry
-    def get_board(self, board):
-        url = THREAD_LIST.format(board=board)
-        pages = requests.get(url).json()
-        threads = list(flatten([page['threads'] for page in pages]))
-        return threads
-
-    @retry
-    def get_thread(self, board, thread):
-        url = THREAD.format(board=board, thread=thread)
-        posts = requests.get(url).json()['posts']
-
-        for post in posts:
-            post['board'] = board
-
-        posts = map(Post, posts)
-
-        return posts
+                elif request.action is Action.Stop:
+                    self.update_request_queue.put(request)
+            except FETCH_ERRORS as ex:
+                logger.exception("Giving up on request {}".format(request))
+                if request.action is Action.LoadAndFollow:
+                    self.response_queue.put([LoadFailed(request.target, is_gone(ex))])
+
+            self.response_queue.put([
+                WorkerStats(current_process().name, fetch_stats(self.fetcher)),
+            ])
+
+    def load_and_follow(self, request):
+        if isinstance(request.target, BoardTarget):
+            # The catalog carries every OP, so one request is
+            # enough to load the whole board
+            board = request.target.board
+            threads = self.get_catalog(board)
+
+            # Seed seen_boards so update_loop doesn't re-fetch them
+            self.update_request_queue.put(SubscriptionUpdate.make(
+                action=Action.InternalQueueUpdate,
+                target=request.target,
+                payload={thread['no']: thread['last_modified'] for thread in threads},
+            ))
+
+            threads.sort(key=itemgetter('last_modified'))
+
+            ops = []
+            for thread in threads:
+                op = Post(thread)
+                op.payload = request.payload
+                ops.append(op)
+
+            self.response_queue.put(ops)
+
+        elif isinstance(request.target, ThreadTarget):
+            posts = list(self.get_thread(
+                request.target.board,
+                request.target.thread
+            ))
+
+            self.update_request_queue.put(SubscriptionUpdate.make(
+                action=Action.InternalQueueUpdate,
+                target=request.target,
+                payload=max(post.post_no for post in posts),
+            ))
+
+            for post in posts:
+                post.payload = request.payload
+
+            self.response_queue.put(posts)
+
+    # The get_* methods return None instead of a result when asked for a
+    # conditional fetch of something that hasn't changed since last time.
+
+    def fetch(self, document, conditional):
+        data = self.fetcher.get_json(document.url, conditional)
+        if data is None:
+            return None
+        return document.parse(data)
+
+    @api_retry
+    def get_board(self, board, conditional=False):
+        return self.fetch(board_document(self.api_base, board), conditional)
+
+    @api_retry
+    def get_catalog(self, board, conditional=False):
+        """Return the OP of every thread on the board as post dicts, each
+        also carrying the thread's last_modified.
+        """
+        return self.fetch(catalog_document(self.api_base, board), conditional)
+
+    @api_retry
+    def get_thread(self, board, thread, conditional=False):
+        return self.fetch(thread_document(self.api_base, board, thread), conditional)
+
+    def poll(self, fetch, *args):
+        """Conditionally fetch with one of the get_* methods. Failures are
+        logged and, like an unchanged result, come back as None, except for
+        a 404, which comes back as GONE.
+        """
+        try:
+            return fetch(*args, conditional=True)
+        except FETCH_ERRORS as ex:
+            if is_gone(ex):
+                logger.info("{}{} is gone".format(fetch.__name__, args))
+                return GONE
+            logger.exception("Failed to poll {}{}".format(fetch.__name__, args))
+            return None
 
     # Timed loop to hit 4chan API
     @proxy_exception_to("response_queue")
     def update_loop(self, response_queue, update_request_queue):
-        # Set of boards that are watched
-        watched_boards = set()
-        # Dictionary of board => set of threads(string) that are watched
-        watched_threads = defaultdict(set)
-
-        # Dictionary of board => {thread_no => last_modified} last seen on board
-        seen_boards = defaultdict(dict)
-        # Dictionary of board, thread => posts last seen on thread
-        seen_threads = defaultdict(lambda: defaultdict(list))
+        # Connections can't be shared with the immediate worker
+        self.fetcher = Fetcher(
+            pool_size=MAX_CONCURRENT_FETCHES,
+            rate_limiter=self.rate_limiter,
+        )
+        executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES)
+
+        # Once the immediate worker that started this one is gone, its
+        # targets are followed by another worker
+        parent = os.getppid()
+
+        # Boards are polled through their catalogs, and threads through
+        # the listings of their boards
+        scheduler = PollScheduler()
+        seen = SeenState()
+        index = ThreadIndex()
+        next_stats = time()
+
+        def unfollow(target):
+            seen.forget(target)
+            if isinstance(target, BoardTarget):
+                scheduler.remove(target)
+            elif index.drop(target):
+                scheduler.remove(ThreadListing(target.board))
+
+        def gone(target):
+            logger.info("{} is gone, no longer following it".format(target))
+            unfollow(target)
+            response_queue.put([TargetGone(target)])
 
         while True:
             # Process pending update requests
             while not update_request_queue.empty():
                 request = update_request_queue.get()
                 if request.action is Action.InternalQueueUpdate:
-                    if isinstance(request.target, BoardTarget):
-                        watched_boards.add(request.target.board)
-                        seen_boards[board] = request.payload
-                    elif isinstance(request.target, ThreadTarget):
-                        # assert request.target.board in watched_boards, "Asked to watch a thread of a board not currently being watched"
-                        watched_threads[request.target.board].add(request.target.thread)
-                        seen_threads[request.target.board][request.target.thread] = request.payload
-
-            # Fetch pending boards
-            pending_boards = defaultdict(dict)
-            for board in watched_boards:
-                pending_boards[board] = {
-                    thread['no']:
-                    thread['last_modified'] for thread in self.get_board(board)
-                }
-
-            to_delete = []
-            for board, threads in pending_boards.items():
-                for thread_no, last_modified in threads.items():
-                    if thread_no not in seen_boards[board]:
-                        thread = list(self.get_thread(board, thread_no))[0]
-                        logger.debug("sending new thread {}".format(thread))
-                        response_queue.put(thread)
-                    elif last_modified > seen_boards[board][thread_no]:
-                        thread = list(self.get_thread(board, thread_no))[0]
-                        logger.debug("sending updated thread {}".format(thread))
-                        response_queue.put(thread)
-                    elif last_modified < seen_boards[board][thread_no]:
-                        # Sometimes we get stale data immediately after reading
-                        # it (tested under SLEEP_TIME = 3). Ignore this data.
-                        to_delete.append((board, thread_no))
-
-            for board, thread_no in to_delete:
-                del pending_boards[board][thread_no]
-
-            seen_boards = pending_boards
-
-            # Fetch pending threads
-            pending_threads = defaultdict(lambda: defaultdict(list))
-            for board, threads in watched_threads.items():
-                for thread in threads:
-                    pending_threads[board][thread] = list(self.get_thread(board, thread))
-
-            for board, threads in pending_threads.items():
-                for thread_no, posts in threads.items():
-                    for post in posts:
-                        if post not in seen_threads[board][thread_no]:
-                            logger.debug("sending new post {}".format(post))
-                            response_queue.put(post)
-
-            seen_threads = pending_threads
-
-            sleep(SLEEP_TIME)
+                    target = request.target
+                    seen.merge(target, request.payload)
+                    if isinstance(target, ThreadTarget):
+                        index.follow(target)
+                        target = ThreadListing(target.board)
+                    scheduler.add(target, time())
+                elif request.action is Action.Stop:
+                    logger.info("no longer following {}".format(request.target))
+                    unfollow(request.target)
+                elif request.action is Action.Shutdown:
+                    logger.info("shutting down")
+                    return
+
+            # Fan out every fetch that is due at once, and handle each one
+            # as soon as it is done, so a slow target holds up nobody else's
+            # posts. Dictionary of future => the target it polls.
+            fetches = {}
+            for target in scheduler.pop_due(time()):
+                if isinstance(target, BoardTarget):
+                    poll = executor.submit(self.poll, self.get_catalog, target.board)
+                else:
+                    poll = executor.submit(self.poll, self.get_board, target.board)
+                fetches[poll] = target
+            polled = bool(fetches)
+
+            # Dictionary of ThreadListing => [fetches left of the threads it
+            # showed to have changed, whether any of them had new posts]
+            listings = {}
+            # Dictionary of ThreadTarget => last_modified it is fetched for,
+            # or None for a thread missing from its listing
+            modified = {}
+            while fetches:
+                done, _ = wait(fetches, return_when=FIRST_COMPLETED)
+                for poll in done:
+                    target = fetches.pop(poll)
+                    result = poll.result()
+
+                    if isinstance(target, ThreadListing):
+                        # Nothing is left on a board that is gone
+                        changed, missing = index.update(target.board, [] if result is GONE else result)
+                        changed.extend((thread, None) for thread in missing)
+                        for thread, last_modified in changed:
+                            fetches[executor.submit(self.poll, self.get_thread, *thread)] = thread
+                            modified[thread] = last_modified
+                        listing = target
+                        listings[listing] = [len(changed), False]
+                    else:
+                        if result is GONE or result is None:
+                            # Unchanged or failed polls leave the seen state alone
+                            new = []
+                        else:
+                            new = seen.update(target, result)
+                            if modified.get(target) is not None:
+                                index.fetched(target, modified[target])
+
+                        # Each target's posts go back together, in the
+                        # order the API lists them
+                        if new:
+                            response_queue.put(new)
+
+                        # Threads missing from their listing stay followed
+                        # unless they turn out to be gone
+                        if result is GONE or isinstance(target, ThreadTarget) and is_archived(result):
+                            gone(target)
+
+                        if isinstance(target, BoardTarget):
+                            if result is not GONE:
+                                scheduler.reschedule(target, bool(new), time())
+                            continue
+                        listing = ThreadListing(target.board)
+                        listings[listing][0] -= 1
+                        listings[listing][1] |= bool(new)
+
+                    # A listing is due again once all its threads are
+                    # fetched, unless its last thread has just gone
+                    left, had_new = listings[listing]
+                    if not left and listing in scheduler:
+                        scheduler.reschedule(listing, had_new, time())
+
+            if os.getppid() != parent:
+                logger.info("immediate api worker has exited, stopping")
+                return
+
+            if polled and time() >= next_stats:
+                response_queue.put([WorkerStats(
+                    current_process().name,
+                    dict(
+                        fetch_stats(self.fetcher),
+                        targets=len(scheduler),
+                        threads=sum(map(len, index.followed.values())),
+                    ),
+                )])
+                next_stats = time() + STATS_INTERVAL
+
+            # Sleep until the next poll is due, waking early for new targets,
+            # and with nothing to poll, often enough to notice the immediate
+            # worker exiting
+            timeout = scheduler.time_until_next(time())
+            if timeout is None:
+                timeout = STATS_INTERVAL
+            update_request_queue._reader.poll(timeout)
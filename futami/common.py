@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from collections import namedtuple
-from html.parser import HTMLParser
+from html import unescape
 import enum
 import re
 
@@ -52,7 +52,113 @@ BOARD_TO_DESCRIPTION = {
     'wg': 'Wallpapers/General',
     'wsg': 'Worksafe GIF',
 }
-unescape = HTMLParser().unescape
+
+# Rules turning comment HTML into IRC formatting, in order of precedence.
+# Each pattern is replaced either with a string, or, for patterns wrapping
+# content in a group, with that content cleaned and wrapped in a
+# (prefix, suffix) pair.
+COMMENT_RULES = [
+    # Some text escaping
+    (r'\[(banned|moot)\]', ('[', ':lit]')),
+
+    # Code tags
+    (r'<pre [^>]*>', '[code]'),
+    (r'</pre>', '[/code]'),
+
+    # Comment too long, exif tag toggle
+    (r'<span class="abbr">.*?</span>', ''),
+
+    # USER WAS * FOR THIS POST
+    (r'<(?:b|strong) style="color:\s*red;">(.*?)</(?:b|strong)>', ('\x0304', '\x0f[/banned]')),
+
+    # moot text
+    (r'<div style="padding: 5px;margin-left: \.5em;border-color: #faa;border: 2px dashed rgba\(255,0,0,\.1\);border-radius: 2px">(.*?)</div>', ('[moot]', '[/moot]')),
+
+    # Bold text
+    (r'<(?:b|strong)>(.*?)</(?:b|strong)>', ('\x02', '\x02')),
+
+    # Who are you quoting?
+    (r'<font class="unkfunc">(.*?)</font>', ('\x0303', '\x0f')),
+    (r'<span class="quote">(.*?)</span>', ('\x0303', '\x0f')),
+    (r'<span class="(?:[^"]*)?deadlink">(.*?)</span>', ('\x0303', '\x0f')),
+
+    # Get rid of links
+    (r'<a[^>]*>(.*?)</a>', ('', '')),
+
+    # Spoilers
+    (r'<span class="spoiler"[^>]*>', '\x0301,01'),
+    (r'</span>', '\x0f'),
+
+    (r'<s>', '\x0301,01'),
+    (r'</s>', '\x0f'),
+
+    # <wbr>
+    (r'<wbr>', ''),
+
+    # Newlines
+    (r'<br>', ' '),
+]
+
+
+def _compile_comment_rules(rules):
+    """Join the rules into one alternation, each in a group named after
+    its position, and map those names to (content group, replacement).
+    """
+    alternatives = []
+    dispatch = {}
+    group = 1
+    for i, (pattern, replacement) in enumerate(rules):
+        name = 'rule{}'.format(i)
+        alternatives.append('(?P<{}>{})'.format(name, pattern))
+        dispatch[name] = (group + 1, replacement)
+        group += 1 + re.compile(pattern).groups
+    return re.compile('|'.join(alternatives)), dispatch
+
+
+_comment_pattern, _comment_dispatch = _compile_comment_rules(COMMENT_RULES)
+
+
+def _replace_rule_markup(replacement):
+    if isinstance(replacement, str):
+        return lambda match: replacement
+    prefix, suffix = replacement
+    return lambda match: prefix + match.group(1) + suffix
+
+
+# The same rules applied one at a time, for comments the single pass
+# cannot clean
+_comment_rules = [
+    (re.compile(pattern), _replace_rule_markup(replacement))
+    for pattern, replacement in COMMENT_RULES
+]
+
+
+def _replace_comment_markup(match):
+    content_group, replacement = _comment_dispatch[match.lastgroup]
+    if isinstance(replacement, str):
+        return replacement
+    prefix, suffix = replacement
+    content = _comment_pattern.sub(_replace_comment_markup, match.group(content_group))
+    return prefix + content + suffix
+
+
+def clean_comment(text):
+    """Convert comment HTML from the API into IRC-formatted plain text."""
+    if not text:
+        return text
+
+    cleaned = _comment_pattern.sub(_replace_comment_markup, text)
+
+    # A tag left over means a wrapped match stopped at the closing tag of a
+    # span nested inside it, leaving that span's opening tag unmatched.
+    # Apply the rules one at a time instead, as they were originally, so
+    # the nested span still gets the closing tag after it.
+    if '<' in cleaned:
+        cleaned = text
+        for pattern, replace in _comment_rules:
+            cleaned = pattern.sub(replace, cleaned)
+
+    return unescape(cleaned)
 
 class SubscriptionUpdate(namedtuple('SubscriptionUpdate', ['action', 'target', 'payload'])):
     @classmethod
@@ -68,9 +174,24 @@ ThreadTarget = namedtuple('ThreadTarget', ['board', 'thread'])
 
 StoredException = namedtuple('StoredException', ['traceback', 'process'])
 
+# Sent back by workers now and then, with a snapshot of their statistics
+WorkerStats = namedtuple('WorkerStats', ['process', 'stats'])
+
+# Sent back by workers when the initial load of a target fails, so it isn't
+# left followed with nothing loaded. gone is whether the API no longer has it.
+LoadFailed = namedtuple('LoadFailed', ['target', 'gone'])
+
+# Sent back by workers when they stop following a target because it has
+# been pruned, deleted or archived
+TargetGone = namedtuple('TargetGone', ['target'])
+
 class Action(enum.Enum):
     LoadAndFollow = 1
     Stop = 2
+    # Follow without loading first, from the seen state in the payload
+    Resume = 3
+    # Stop following everything, and exit
+    Shutdown = 4
 
     InternalQueueUpdate = 100
 
@@ -98,21 +219,9 @@ class Image(namedtuple('Image', ['filename', 'tim', 'ext', 'fsize', 'md5', 'w',
 
 
 class Post:
-    # Because moot is bad at updating the API documentation, the second
-    # set of fields are not listed in the API documentation.
-    # The third set of fields are values that are synthesized by us.
-    post_fields = [
-        'no', 'resto', 'sticky', 'closed', 'now', 'time', 'name', 'trip',
-        'filename', 'id', 'capcode', 'country', 'country_name', 'email', 'sub',
-        'com', 'tim', 'ext', 'fsize', 'md5', 'w', 'h', 'tn_w', 'tn_h',
-        'filedeleted', 'spoiler', 'custom_spoiler', 'omitted_posts',
-        'omitted_images', 'replies', 'images', 'bumplimit', 'imagelimit',
-        'capcode_replies', 'last_modified', 'tag', 'semantic_url',
-
-        'unique_ips',
-
-        'board',
-    ]
+    """A single post, holding only the fields of the API's post object
+    that the bridge makes use of.
+    """
 
     interface_field_map = {
         'post_no': 'no',
@@ -123,36 +232,58 @@ class Post:
         'subject': 'sub',
         'raw_comment': 'com',
         'board': 'board',
+        # Only set on OPs that came from the catalog
+        'last_modified': 'last_modified',
+        # Only set on the OPs of archived threads
+        'archived': 'archived',
     }
 
-    identifier = None
+    # Image fields are only kept for posts with an image, in this order
+    image_fields = ('filename', 'tim', 'ext', 'fsize', 'md5', 'w', 'h',
+                    'tn_w', 'tn_h')
+
+    __slots__ = tuple(interface_field_map) + (
+        '_image_data',
+        '_text',
+        'identifier',
+        'payload',
+    )
 
     def __init__(self, data):
-        missing_fields = set(self.post_fields).difference(data.keys())
-        data.update({field: None for field in missing_fields})
-
-        self.data = data
-
-        self._image = Image(
-            self.data['filename'],
-            self.data['tim'],
-            self.data['ext'],
-            self.data['fsize'],
-            self.data['md5'],
-            self.data['w'],
-            self.data['h'],
-            self.data['tn_w'],
-            self.data['tn_h'],
-            self.data['board'],
-        )
-
-    def __getattr__(self, name):
-        if name in self.interface_field_map:
-            return self.data[self.interface_field_map[name]]
-        raise AttributeError("'{0}' object has no attribute '{1}'".format(
-            self.__class__.__name__,
-            name,
-        ))
+        for name, field in self.interface_field_map.items():
+            setattr(self, name, data.get(field))
+
+        if data.get('tim'):
+            self._image_data = tuple(data.get(field) for field in self.image_fields)
+        else:
+            self._image_data = None
+
+        self._text = None
+        self.identifier = None
+        self.payload = None
+
+    # Pickle as a bare tuple of values, rather than a dict keyed by slot name
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def to_data(self):
+        """Return the fields kept from the API's post object, in a form
+        that Post can be made from again. Unset fields are left out.
+        """
+        data = {}
+        for name, field in self.interface_field_map.items():
+            value = getattr(self, name)
+            if value is not None:
+                data[field] = value
+
+        if self._image_data:
+            data.update(zip(self.image_fields, self._image_data))
+
+        return data
 
     def __repr__(self):
         return "<Post {0}/{1}>".format(self.board, self.post_no)
@@ -160,9 +291,16 @@ class Post:
     def __eq__(self, other):
         return isinstance(other, Post) and self.post_no == other.post_no
 
+    @property
+    def text(self):
+        """The cleaned comment, converted once and then kept."""
+        if self._text is None:
+            self._text = self.clean(self.raw_comment)
+        return self._text
+
     @property
     def comment(self):
-        comment = self.clean(self.raw_comment)
+        comment = self.text
 
         if self.image:
             comment = "[{}] {}".format(self.image.image_url, comment)
@@ -171,7 +309,7 @@ class Post:
 
     @property
     def summary(self):
-        comment = self.clean(self.raw_comment)
+        comment = self.text
 
         if not comment:
             comment = '(no post text)'
@@ -192,9 +330,9 @@ class Post:
 
     @property
     def image(self):
-        if not self.data['tim']:
+        if not self._image_data:
             return None
-        return self._image
+        return Image(*self._image_data, board=self.board)
 
     @property
     def is_reply(self):
@@ -205,49 +343,4 @@ class Post:
         return self.reply_to != 0
 
     def clean(self, text):
-        if not text:
-            return text
-
-        # Some text escaping
-        text = re.sub(r'\[(banned|moot)\]', r'[\1:lit]', text)
-
-        # Code tags
-        text = re.sub(r'<pre [^>]*>', r'[code]', text)
-        text = re.sub(r'</pre>', r'[/code]', text)
-
-        # Comment too long, exif tag toggle
-        text = re.sub(r'<span class="abbr">.*?</span>', r'', text)
-
-        # USER WAS * FOR THIS POST
-        text = re.sub(r'<(?:b|strong) style="color:\s*red;">(.*?)</(?:b|strong)>', r'\x0304\1\x0f[/banned]', text)
-
-        # moot text
-        text = re.sub(r'<div style="padding: 5px;margin-left: \.5em;border-color: #faa;border: 2px dashed rgba\(255,0,0,\.1\);border-radius: 2px">(.*?)</div>', r'[moot]\1[/moot]', text)
-
-        # Bold text
-        text = re.sub(r'<(?:b|strong)>(.*?)</(?:b|strong)>', '\x02\1\x02', text)
-
-        # Who are you quoting?
-        text = re.sub(r'<font class="unkfunc">(.*?)</font>', '\x0303\1\x0f', text)
-        text = re.sub(r'<span class="quote">(.*?)</span>', '\x0303\1\x0f', text)
-        text = re.sub(r'<span class="(?:[^"]*)?deadlink">(.*?)</span>', '\x0303\1\x0f', text)
-
-        # Get rid of links
-        text = re.sub(r'<a[^>]*>(.*?)</a>', r'\1', text)
-
-        # Spoilers
-        text = re.sub(r'<span class="spoiler"[^>]*>', '\x0301,01', text)
-        text = re.sub(r'</span>', '\x0f', text)
-
-        text = re.sub(r'<s>', '\x0301,01', text)
-        text = re.sub(r'</s>', '\x0f', text)
-
-        # <wbr>
-        text = re.sub(r'<wbr>', '', text)
-
-        # Newlines
-        text = re.sub(r'<br>', ' ', text)
-
-        text = unescape(text)
-
-        return text
+        return clean_comment(text)
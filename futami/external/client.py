@@ -1,27 +1,72 @@
 # -*- coding: utf8 -*-
 
-from collections import defaultdict
+from collections import (
+    OrderedDict,
+    deque,
+)
 from datetime import datetime
-from multiprocessing import SimpleQueue
-from multiprocessing import Process
+from itertools import islice
 import logging
+import os
 import re
 import socket
+import ssl
 import time
 
-from futami.ami import Ami
 from futami.common import (
     Action,
     BoardTarget,
     BOARD_TO_DESCRIPTION,
+    LoadFailed,
+    Post,
     StoredException,
     SubscriptionUpdate,
+    TargetGone,
     ThreadTarget,
+    WorkerStats,
 )
 from futami.external.channel import Channel
+from futami.external.subscription import Subscription
+from futami.fetch import RateLimiter
+from futami.ipc import BatchQueue
+from futami.metrics import (
+    Metrics,
+    flatten,
+)
+from futami.pool import AmiPool
+from futami.search import SearchIndex
+from futami.state import StateStore
 
 VERSION = "0.4"
 
+# Clients with more than this many bytes of unsent output are disconnected
+WRITE_BUFFER_HIGH_WATER = 4 * 2 ** 20
+
+# Most buffers a single sendmsg call will take
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError):
+    IOV_MAX = 16
+
+# SSL sockets can't sendmsg, so their chunks are joined up to this size
+SSL_WRITE_SIZE = 2 ** 14
+
+# Seconds a board or thread is still followed after its last watcher left,
+# so that rejoining soon after, or reconnecting after a restart, doesn't
+# need it loaded again
+UNFOLLOW_GRACE = 300
+
+# Initial loads are sent to their watchers this many posts at a time, in
+# turn with other loads, between rounds of the server loop
+LOAD_CHUNK = 50
+
+# Most posts added to the search index per round of the server loop
+INDEX_CHUNK = 200
+
+# Channels named after boards and threads, e.g. #/g/ and #/g/12345
+_board_channel_regexp = re.compile(r'#/(.+)/$')
+_thread_channel_regexp = re.compile(r'#/(.+)/(\d+)$')
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
@@ -53,7 +98,10 @@ class Client(object):
         (self.host, self.port) = socket.getpeername()
         self.__timestamp = time.time()
         self._readbuffer = ""
-        self._writebuffer = ""
+        # Encoded output waiting to be sent, as a queue of chunks
+        self._writebuffer = deque()
+        self._writebuffer_size = 0
+        self._sendq_exceeded = False
         self.__sent_ping = False
         if self.server.password:
             self._handle_command = self.__pass_handler
@@ -79,7 +127,7 @@ class Client(object):
                 self.disconnect("ping timeout")
 
     def write_queue_size(self):
-        return len(self._writebuffer)
+        return self._writebuffer_size
 
     def _parse_read_buffer(self):
         lines = self.__linesep_regexp.split(self._readbuffer)
@@ -172,7 +220,8 @@ class Client(object):
                 for (channelname, channel) in list(self.channels.items()):
                     self.message_channel(channel, "PART", channelname, True)
                     self.channel_log(channel, "left", meta=True)
-                    server.remove_member_from_channel(self, channelname)
+                    channel.remove_client(self)
+                    server.internal_client.client_parted(self, channel)
                 self.channels = {}
                 return
             channelnames = arguments[0].split(",")
@@ -376,6 +425,8 @@ class Client(object):
                         True)
                     self.channel_log(channel, "left (%s)" % partmsg, meta=True)
                     del self.channels[irc_lower(channelname)]
+                    channel.remove_client(self)
+                    server.internal_client.client_parted(self, channel)
 
         def ping_handler():
             if len(arguments) < 1:
@@ -393,6 +444,47 @@ class Client(object):
                 quitmsg = arguments[0]
             self.disconnect(quitmsg)
 
+        def search_handler():
+            if len(arguments) < 2:
+                self.reply_461("SEARCH")
+                return
+            scope = arguments[0]
+            query = " ".join(arguments[1:])
+
+            # A board or thread channel, or * for everything
+            board = thread = None
+            if scope != "*":
+                m = _thread_channel_regexp.match(scope)
+                if m:
+                    board, thread = m.group(1), int(m.group(2))
+                else:
+                    m = _board_channel_regexp.match(scope)
+                    if not m:
+                        self.reply_403(scope)
+                        return
+                    board = m.group(1)
+
+            results = server.internal_client.search_index.search(query, board, thread)
+            for result in results:
+                post = result.post
+                self.reply("NOTICE %s :#/%s/%d >>%d %s"
+                           % (self.nickname, post.board, post.thread,
+                              post.post_no, post.snippet))
+            self.reply("NOTICE %s :End of SEARCH, %d results for %s in %s"
+                       % (self.nickname, len(results), query, scope))
+
+        def stats_handler():
+            # Only keys starting with the optional argument are listed
+            prefix = arguments[0] if arguments else ""
+            for key, value in flatten(server.stats()):
+                if not key.startswith(prefix):
+                    continue
+                if isinstance(value, float):
+                    value = "%.6g" % value
+                self.reply("249 %s :%s %s" % (self.nickname, key, value))
+            self.reply("219 %s %s :End of STATS report"
+                       % (self.nickname, prefix or "*"))
+
         def topic_handler():
             if len(arguments) < 1:
                 self.reply_461("TOPIC")
@@ -477,6 +569,8 @@ class Client(object):
             "PONG": pong_handler,
             "PRIVMSG": notice_and_privmsg_handler,
             "QUIT": quit_handler,
+            "SEARCH": search_handler,
+            "STATS": stats_handler,
             "TOPIC": topic_handler,
             "WALLOPS": wallops_handler,
             "WHO": who_handler,
@@ -509,12 +603,34 @@ class Client(object):
 
     def socket_writable_notification(self):
         try:
-            sent = self.socket.send(self._writebuffer.encode('utf-8'))
-            logger.debug('[%s:%d] <- %r',
-                         self.host, self.port, self._writebuffer[:sent])
-            self._writebuffer = self._writebuffer[sent:]
+            if isinstance(self.socket, ssl.SSLSocket):
+                chunks = []
+                size = 0
+                for chunk in self._writebuffer:
+                    if chunks and size + len(chunk) > SSL_WRITE_SIZE:
+                        break
+                    chunks.append(chunk)
+                    size += len(chunk)
+                sent = self.socket.send(b"".join(chunks))
+            else:
+                sent = self.socket.sendmsg(islice(self._writebuffer, IOV_MAX))
+            logger.debug('[%s:%d] <- %d bytes', self.host, self.port, sent)
         except socket.error as x:
             self.disconnect(x)
+            return
+
+        self._writebuffer_size -= sent
+        while sent:
+            chunk = self._writebuffer[0]
+            if len(chunk) <= sent:
+                self._writebuffer.popleft()
+                sent -= len(chunk)
+            else:
+                self._writebuffer[0] = chunk[sent:]
+                sent = 0
+
+        if not self._writebuffer:
+            self.server.set_write_interest(self, False)
 
     def disconnect(self, quitmsg):
         self.message("ERROR :%s" % quitmsg)
@@ -525,7 +641,25 @@ class Client(object):
         self.server.remove_client(self, quitmsg)
 
     def message(self, msg):
-        self._writebuffer += msg + "\r\n"
+        self.write((msg + "\r\n").encode('utf-8'))
+
+    def write(self, data):
+        """Queue already encoded output, including its line ending."""
+        if self._sendq_exceeded:
+            return
+        if not self._writebuffer:
+            self.server.set_write_interest(self, True)
+        self._writebuffer.append(data)
+        self._writebuffer_size += len(data)
+
+        if self._writebuffer_size > self.server.sendq:
+            # Disconnecting here could pull the client out of a channel
+            # that is being iterated over, so leave it to the server
+            self._sendq_exceeded = True
+            self._writebuffer.clear()
+            self._writebuffer_size = 0
+            self.server.set_write_interest(self, False)
+            self.server.schedule_disconnect(self, "SendQ exceeded")
 
     def reply(self, msg):
         self.message(":%s %s" % (self.server.name, msg))
@@ -604,79 +738,246 @@ class InternalClient(Client):
         self.host = host
 
         self._readbuffer = ""
-        self._writebuffer = ""
-        self.request_queue = SimpleQueue()
-        self.response_queue = SimpleQueue()
+        self._writebuffer = deque()
+        self._writebuffer_size = 0
+        self._sendq_exceeded = False
+        self.response_queue = BatchQueue()
+        self.rate_limiter = RateLimiter(server.api_rate, server.api_burst)
+
+        # dict of BoardTarget or ThreadTarget => Subscription
+        self.subscriptions = {}
+
+        self.metrics = Metrics()
+        # dict of worker process name => the last stats it sent
+        self.worker_stats = {}
+
+        # Initial loads still being sent, as (subscription, watchers when
+        # it was loaded, deque of posts left to send)
+        self.streams = deque()
+
+        # Posts are indexed for SEARCH a round of the server loop after
+        # they were sent, so indexing doesn't hold up their delivery
+        self.search_index = SearchIndex()
+        self.unindexed = deque()
+
+        # Requests go to the worker that follows the target's board
+        self.pool = AmiPool(
+            server.api_workers,
+            self.response_queue,
+            self.rate_limiter,
+            engine=server.engine,
+            api_base=server.api_base,
+        )
 
-        # dict of board => list of users
-        self.board_watchers = defaultdict(list)
+        if server.statedir:
+            self.state = StateStore(server.statedir)
+            self._restore_subscriptions()
+        else:
+            self.state = None
+
+    def _restore_subscriptions(self):
+        """Rebuild the subscriptions saved in the state directory, and have
+        Ami go on following them from where they left off instead of
+        loading them again when their watchers come back.
+        """
+        for target, posts in self.state.load().items():
+            subscription = self.subscriptions[target] = Subscription(target)
+            for data in posts:
+                subscription.remember(Post(data))
+            # So that returning watchers have something to be caught up with
+            for post in subscription.snapshot.values():
+                subscription.add_line(self._render_post(subscription, post), post.post_no)
+            self.unindexed.extend(subscription.snapshot.values())
+            self._resume(subscription)
+
+        # Start over from just what was kept
+        self.state.compact(self.subscriptions)
+
+    def _resume(self, subscription):
+        """Have Ami follow a subscription on from the posts in its
+        snapshot.
+        """
+        if subscription.is_board:
+            seen = {
+                op.post_no: op.last_modified or 0
+                for op in subscription.snapshot.values()
+            }
+        else:
+            seen = max(subscription.snapshot, default=0)
 
-        # dict of board, thread => list of users
-        self.thread_watchers = defaultdict(lambda: defaultdict(list))
+        logger.debug("resuming {} with {} posts".format(
+            subscription, len(subscription.snapshot)))
+        self.pool.put(
+            SubscriptionUpdate.make(
+                action=Action.Resume,
+                target=subscription.target,
+                payload=seen,
+        ))
 
-        Process(
-            target=Ami,
-            name='immediate api worker',
-            args=(self.request_queue, self.response_queue)
-        ).start()
+    def reap_workers(self):
+        """Hand the targets of any workers that have died to the ones that
+        are left. Called once a worker's sentinel is ready.
+        """
+        # Who owned what has to be worked out before the dead are taken out
+        # of the ring
+        owners = {target: self.pool.owner(target) for target in self.subscriptions}
+        dead = self.pool.reap()
+        for worker in dead:
+            self.server.selector.unregister(worker.process.sentinel)
+            for name in worker.process_names:
+                self.worker_stats.pop(name, None)
+
+        if not self.pool:
+            raise RuntimeError("All api workers have exited")
+
+        for target, subscription in self.subscriptions.items():
+            if owners[target] in dead:
+                self._resume(subscription)
 
     def loop_hook(self):
-        while not self.response_queue.empty():
-            result = self.response_queue.get()
-
-            # Handle exceptions in-band from child workers here.
-            if isinstance(result, StoredException):
-                print(result.traceback)
-                raise RuntimeError(
-                    "Exception caught from worker '{}', see above for exception details".format(
-                        result.process,
-                ))
-
-            logger.debug("read from response queue {}".format(result))
-
-            send_as = "/{}/{}".format(result.board, result.post_no)
-
-            # Initial channel loads have identifiers, use them to find out
-            # where to go
-            if result.identifier:
-                client, channel, target = result.identifier
-                client = self.server.get_client(client)
-                logger.debug("initial channel load, using identitifier info: sending to {} on {}".format(client, channel))
-
-                if isinstance(target, BoardTarget):
-                    self._send_message(
-                        client, channel, result.summary,
-                        sending_nick=send_as,
-                    )
-                    continue
-                elif isinstance(target, ThreadTarget):
-                    self._send_message(
-                        client, channel, result.comment,
-                        sending_nick=send_as,
-                    )
-                    continue
+        started = time.monotonic()
+
+        # Everything the workers have sent since the last wakeup comes off
+        # the queue in one read. Initial loads carry the target they were
+        # loaded for, which for a thread includes its OP.
+        loads = OrderedDict()
+        for batch in self.response_queue.get_batches():
+            for result in batch.items:
+                if isinstance(result, Post) and result.payload is not None:
+                    loads.setdefault(result.payload, []).append(result)
+                else:
+                    self._deliver(result)
 
-            if result.is_reply:  # Send to thread channel
-                channel = "#/{}/{}".format(result.board, result.reply_to)
-                logger.debug("sending reply to channel {}".format(channel))
-
-                # TODO: Remove users who have disconnected from the server here
-                for client in self.thread_watchers[result.board][result.reply_to]:
-                    logger.debug("sending reply to {}".format(client))
-                    self._send_message(
-                        client, channel, result.comment,
-                        sending_nick=send_as,
-                    )
-            else:
-                channel = "#/{}/".format(result.board)
-                logger.debug("sending thread update to channel {}".format(channel))
+        for target, posts in loads.items():
+            self._start_stream(target, posts)
+
+        if self.state:
+            self.state.flush()
+            self.state.maybe_compact(self.subscriptions)
 
-                # TODO: Remove users who have disconnected from the server here
-                for client in self.board_watchers[result.board]:
-                    self._send_message(
-                        client, channel, result.summary,
-                        sending_nick=send_as,
-                    )
+        self.metrics.observe('loop_hook_time', time.monotonic() - started)
+
+    def _start_stream(self, target, posts):
+        """Take in the initial load of a target, and queue it to be sent
+        to the target's watchers a chunk at a time by stream_loads.
+        """
+        subscription = self.subscriptions.get(target)
+        if subscription is None:
+            logger.debug("nobody is watching {}, dropping its load".format(target))
+            self.metrics.incr('posts_dropped', len(posts))
+            return
+
+        # Anyone joining from now on is caught up from the snapshot
+        for post in posts:
+            subscription.remember(post)
+            if self.state:
+                self.state.record(target, post)
+
+        newest = self.server.initial_posts
+        if newest and len(posts) > newest:
+            # The newest go first, and the older ones are backfilled after
+            posts = posts[-newest:] + posts[:-newest]
+
+        self.streams.append((subscription, list(subscription.watchers), deque(posts)))
+        self.metrics.incr('loads')
+
+    def stream_loads(self):
+        """Send the next chunk of each initial load still being sent."""
+        for _ in range(len(self.streams)):
+            subscription, watchers, posts = self.streams.popleft()
+
+            # Skip those who have left since. The load still goes on into
+            # the scrollback, for whoever joins next.
+            watching = set(subscription.watchers)
+            watchers = [client for client in watchers if client in watching]
+
+            for _ in range(min(LOAD_CHUNK, len(posts))):
+                self._send_post(subscription, watchers, posts.popleft())
+
+            if posts:
+                self.streams.append((subscription, watchers, posts))
+
+    def index_posts(self, count):
+        """Add the oldest count posts waiting to be indexed to the search
+        index, up to INDEX_CHUNK of them.
+        """
+        started = time.monotonic()
+        for _ in range(min(count, INDEX_CHUNK, len(self.unindexed))):
+            self.search_index.add(self.unindexed.popleft())
+        self.metrics.observe('index_time', time.monotonic() - started)
+
+    def stats(self):
+        """Return what the internal client and the api workers have been
+        up to, as nested dicts.
+        """
+        return {
+            'subscriptions': len(self.subscriptions),
+            'watchers': sum(
+                len(subscription.watchers)
+                for subscription in self.subscriptions.values()
+            ),
+            'idle_subscriptions': sum(
+                1 for subscription in self.subscriptions.values()
+                if subscription.idle_since is not None
+            ),
+            'api_workers': len(self.pool),
+            'streams': len(self.streams),
+            'search_index': {
+                'posts': len(self.search_index),
+                'unindexed': len(self.unindexed),
+            },
+            'response_queue': dict(
+                self.response_queue.stats,
+                latency=self.response_queue.latency.as_dict(),
+                depth=self.response_queue.depth.as_dict(),
+            ),
+            'delivery': self.metrics.snapshot(),
+            'workers': self.worker_stats,
+        }
+
+    def _deliver(self, result):
+        # Handle exceptions in-band from child workers here. The worker is
+        # stopped, and its targets are moved once it has exited.
+        if isinstance(result, StoredException):
+            print(result.traceback)
+            logger.error(
+                "Exception caught from worker '{}', see above for exception details".format(
+                    result.process,
+            ))
+            self.pool.retire(result.process)
+            return
+
+        if isinstance(result, WorkerStats):
+            self.worker_stats[result.process] = result.stats
+            return
+
+        if isinstance(result, LoadFailed):
+            self._load_failed(result.target, result.gone)
+            return
+
+        if isinstance(result, TargetGone):
+            self._target_gone(result.target)
+            return
+
+        logger.debug("read from response queue {}".format(result))
+
+        if result.is_reply:
+            target = ThreadTarget(result.board, result.reply_to)
+        else:
+            target = BoardTarget(result.board)
+
+        subscription = self.subscriptions.get(target)
+        if subscription is None:
+            logger.debug("nobody is watching {}, dropping {}".format(target, result))
+            self.metrics.incr('posts_dropped')
+            return
+
+        logger.debug("sending {} to {}".format(result, subscription))
+        subscription.remember(result)
+        if self.state:
+            self.state.record(target, result)
+
+        self._send_post(subscription, subscription.watchers, result)
 
     def _parse_prefix(self, prefix):
         m = re.search(
@@ -704,14 +1005,14 @@ class InternalClient(Client):
         logger.debug("InternalClient handling {} joined {}".format(client, channel))
 
         channel_registration_map = {
-            r'#/(.+)/$': self._client_register_board,
-            r'#/(.+)/(\d+)$': self._client_register_thread,
+            _board_channel_regexp: self._client_register_board,
+            _thread_channel_regexp: self._client_register_thread,
         }
 
         matched_registration = False
 
         for regex, register_method in channel_registration_map.items():
-            m = re.match(regex, channel.name)
+            m = regex.match(channel.name)
             if m:
                 register_method(client, channel, *m.groups())
                 matched_registration = True
@@ -724,6 +1025,34 @@ class InternalClient(Client):
             )
             return
 
+    def client_parted(self, client, channel):
+        """Stop sending a client what is posted to a channel it has left
+        or, by disconnecting, lost.
+        """
+        m = _thread_channel_regexp.match(channel.name)
+        if m:
+            target = ThreadTarget(m.group(1), int(m.group(2)))
+        else:
+            m = _board_channel_regexp.match(channel.name)
+            if not m:
+                return
+            target = BoardTarget(m.group(1))
+
+        subscription = self.subscriptions.get(target)
+        if subscription is None:
+            return
+        logger.debug("InternalClient handling {} left {}".format(client, channel))
+        subscription.remove_watcher(client)
+
+    def expire_subscriptions(self):
+        """Unfollow every target that has gone without watchers for longer
+        than the server's unfollow grace period.
+        """
+        deadline = time.time() - self.server.unfollow_grace
+        for target, subscription in list(self.subscriptions.items()):
+            if subscription.idle_since is not None and subscription.idle_since < deadline:
+                self._unsubscribe(target)
+
     def _handle_command(self, command, arguments):
         # sending_client = self.sending_client
         # self.sending_client = None
@@ -741,16 +1070,7 @@ class InternalClient(Client):
             sending_nick=slash_board,
         )
 
-        target = BoardTarget(board)
-
-        self.request_queue.put(
-            SubscriptionUpdate.make(
-                action=Action.LoadAndFollow,
-                target=target,
-                payload=(client.nickname, channel.name, target),
-        ))
-
-        self.board_watchers[board].append(client)
+        self._subscribe(client, BoardTarget(board))
 
     def _client_register_thread(self, client, channel, board, thread):
         logging.debug("registering to thread: {}, {}, {}, {}".format(client, channel, board, thread))
@@ -763,30 +1083,123 @@ class InternalClient(Client):
             sending_nick=slash_board_thread,
         )
 
-        target = ThreadTarget(board, thread)
-
-        self.request_queue.put(
+        # Thread reply_tos are ints when they come back from the API
+        self._subscribe(client, ThreadTarget(board, int(thread)))
+
+    def _subscribe(self, client, target):
+        subscription = self.subscriptions.get(target)
+
+        if subscription is None:
+            # First watcher, so have Ami load the target and follow it
+            subscription = self.subscriptions[target] = Subscription(target)
+            if self.state:
+                self.state.follow(target)
+            self.pool.put(
+                SubscriptionUpdate.make(
+                    action=Action.LoadAndFollow,
+                    target=target,
+                    payload=target,
+            ))
+        else:
+            # Already followed, so catch up on what was sent since this
+            # client last watched, if ever, without asking the API
+            lines = subscription.replay(client)
+            logger.debug("replaying {} lines of {} to {}".format(
+                len(lines), subscription, client))
+            for line in lines:
+                client.write(line)
+            self.metrics.incr('lines_replayed', len(lines))
+
+            # Loads still being sent carry on from where the scrollback
+            # ends
+            for stream_subscription, watchers, _ in self.streams:
+                if stream_subscription is subscription:
+                    watchers.append(client)
+
+        subscription.add_watcher(client)
+
+    def _load_failed(self, target, gone):
+        """Tell the watchers of a target that it couldn't be loaded, and
+        drop it. Nothing follows it, so the next JOIN loads it afresh.
+        """
+        if gone:
+            message = "Couldn't load {}, it is gone"
+        else:
+            message = "Couldn't load {}, part and join again to retry"
+        if self._drop(target, message):
+            self.metrics.incr('loads_failed')
+
+    def _target_gone(self, target):
+        """Tell the watchers of a target that its worker stopped following
+        it, and drop it.
+        """
+        if self._drop(target, "{} is gone, no longer following it"):
+            self.metrics.incr('targets_gone')
+
+    def _drop(self, target, message):
+        """Drop the subscription to a target that no worker follows, sending
+        its watchers the message formatted with the target's slash name.
+        Returns whether there was a subscription to drop.
+        """
+        subscription = self.subscriptions.pop(target, None)
+        if subscription is None:
+            return False
+        if self.state:
+            self.state.unfollow(target)
+
+        slash_target = subscription.channel[1:]
+        message = message.format(slash_target)
+        for client in subscription.watchers:
+            self._send_message(client, subscription.channel, message, sending_nick=slash_target)
+        return True
+
+    def _unsubscribe(self, target):
+        logger.info("nobody has watched {} for a while, unfollowing it".format(target))
+        del self.subscriptions[target]
+        if self.state:
+            self.state.unfollow(target)
+        self.pool.put(
             SubscriptionUpdate.make(
-                action=Action.LoadAndFollow,
+                action=Action.Stop,
                 target=target,
-                payload=(client.nickname, channel.name, target),
+                payload=None,
         ))
 
-        # Thread reply_tos are ints when they come back from the API
-        self.thread_watchers[board][int(thread)].append(client)
+    def _post_nick(self, post):
+        return "/{}/{}".format(post.board, post.post_no)
 
-    def _send_message(self, client, channel, message, sending_nick=None):
-        if sending_nick:
-            real_nick = self.nickname
-            self.nickname = sending_nick
-
-        client.message(
-            ":{} PRIVMSG {} :{}".format(
-                self.prefix,
-                channel,
-                message,
-            )
+    def _render_post(self, subscription, post):
+        return self._render_message(
+            subscription.channel,
+            subscription.text(post),
+            sending_nick=self._post_nick(post),
         )
 
-        if sending_nick:
-            self.nickname = real_nick
+    def _send_post(self, subscription, watchers, post):
+        """Send a post to watchers of a subscription, and keep the line in
+        its scrollback.
+        """
+        # Every watcher gets the very same bytes object
+        line = self._render_post(subscription, post)
+        subscription.add_line(line, post.post_no)
+        for client in watchers:
+            client.write(line)
+        self.unindexed.append(post)
+
+        self.metrics.incr('posts_delivered')
+        self.metrics.incr('lines_delivered', len(watchers))
+
+    def _render_message(self, channel, message, sending_nick=None):
+        """Encode a PRIVMSG line from the internal client, optionally
+        appearing to come from sending_nick instead.
+        """
+        return ":{}!{}@{} PRIVMSG {} :{}\r\n".format(
+            sending_nick or self.nickname,
+            self.user,
+            self.host,
+            channel,
+            message,
+        ).encode('utf-8')
+
+    def _send_message(self, client, channel, message, sending_nick=None):
+        client.write(self._render_message(channel, message, sending_nick))
@@ -23,7 +23,7 @@
 import logging
 import os
 import re
-import select
+import selectors
 import ssl
 import socket
 import sys
@@ -33,11 +33,28 @@ from optparse import OptionParser
 
 from futami.external.client import Client
 from futami.external.client import InternalClient
+from futami.external.client import UNFOLLOW_GRACE
+from futami.external.client import WRITE_BUFFER_HIGH_WATER
+from futami.ami import API_BASE
+from futami.fetch import API_BURST
+from futami.fetch import API_RATE
+from futami.metrics import Histogram
+from futami.metrics import Metrics
+from futami.metrics import SIZE_BUCKETS
+from futami.metrics import dump
+from futami.pool import API_WORKERS
+from futami.pool import ENGINES
 
 logger = logging.getLogger(__name__)
 
 VERSION = "0.4"
 
+# Seconds between dumps of the server's stats, with --stats-dump
+STATS_INTERVAL = 10
+
+# Seconds between checks for dead clients and unwatched subscriptions
+HOUSEKEEPING_INTERVAL = 10
+
 
 def create_directory(path):
     if not os.path.isdir(path):
@@ -60,6 +77,18 @@ class Server(object):
         self.chroot = options.chroot
         self.setuid = options.setuid
         self.statedir = options.statedir
+        self.api_rate = options.api_rate
+        self.api_burst = options.api_burst
+        self.api_workers = options.api_workers
+        self.engine = options.engine
+        self.api_base = options.api_base.rstrip("/")
+        self.sendq = options.sendq
+        self.unfollow_grace = options.unfollow_grace
+        self.initial_posts = options.initial_posts
+        self.stats_dump = options.stats_dump
+        self.stats_interval = options.stats_interval
+        self.started = time.time()
+        self.metrics = Metrics()
 
         if options.listen:
             self.address = socket.gethostbyname(options.listen)
@@ -68,6 +97,7 @@ class Server(object):
         self.name = socket.getfqdn(self.address)[:63]  # RFC 2813 2.1
 
         self.clients = {}  # Socket --> Client instance.
+        self.pending_disconnects = []  # (Client instance, quit message)
         self.nicknames = {}  # irc_lower(Nickname) --> Client instance.
         if self.logdir:
             create_directory(self.logdir)
@@ -125,12 +155,56 @@ class Server(object):
         for x in list(client.channels.values()):
             client.channel_log(x, "quit (%s)" % quitmsg, meta=True)
             x.remove_client(client)
+            self.internal_client.client_parted(client, x)
         if client.nickname \
                 and irc_lower(client.nickname) in self.nicknames:
             del self.nicknames[irc_lower(client.nickname)]
         del self.clients[client.socket]
+        try:
+            self.selector.unregister(client.socket)
+        except (KeyError, ValueError):
+            pass
+
+    def schedule_disconnect(self, client, quitmsg):
+        """Disconnect a client once the current event has been handled."""
+        self.pending_disconnects.append((client, quitmsg))
+        self.metrics.incr('sendq_disconnects')
+
+    def stats(self):
+        """Return the server's runtime statistics, and those of the
+        internal client and its api workers, as nested dicts.
+        """
+        write_buffers = Histogram(SIZE_BUCKETS)
+        for client in self.clients.values():
+            write_buffers.observe(client.write_queue_size())
+
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'clients': len(self.clients),
+            'server': dict(
+                self.metrics.snapshot(),
+                write_buffers=write_buffers.as_dict(),
+            ),
+            'internal': self.internal_client.stats(),
+        }
+
+    def set_write_interest(self, client, interested):
+        """Called by clients as their write buffer becomes non-empty and
+        empty again, so only clients with pending output are polled for
+        writability.
+        """
+        events = selectors.EVENT_READ
+        if interested:
+            events |= selectors.EVENT_WRITE
+        try:
+            self.selector.modify(client.socket, events, client)
+        except (KeyError, ValueError):
+            # Not registered, e.g. already disconnected
+            pass
 
     def start(self):
+        self.selector = selectors.DefaultSelector()
         self.server_sockets = []
         for port in self.ports:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -142,6 +216,7 @@ class Server(object):
                 sys.exit(1)
             s.listen(5)
             self.server_sockets.append(s)
+            self.selector.register(s, selectors.EVENT_READ)
             logger.info("Listening on port %d.", port)
         if self.chroot:
             os.chdir(self.chroot)
@@ -157,46 +232,96 @@ class Server(object):
         self.run_loop()
 
     def run_loop(self):
-        while True:
-            queue_pseudo_socket = self.internal_client.response_queue._reader
-            client_sockets = [
-                client.socket
-                for client in list(self.clients.values())
-            ]
-            (readable_sockets, writable_sockets, _) = select.select(
-                self.server_sockets + client_sockets + [queue_pseudo_socket],
-                [client.socket for client in list(self.clients.values())
-                if client.write_queue_size() > 0],
-                [],
-            )
-
-            if queue_pseudo_socket in readable_sockets:
-                self.internal_client.loop_hook()
-                readable_sockets.remove(queue_pseudo_socket)
+        # Sockets stay registered with the selector for as long as they
+        # are open. Listening sockets carry no data, client sockets carry
+        # their Client, and the Ami response queue carries the internal
+        # client.
+        self.selector.register(
+            self.internal_client.response_queue,
+            selectors.EVENT_READ,
+            self.internal_client,
+        )
+        # So do the api workers' process sentinels, which become readable
+        # when a worker exits
+        for sentinel in self.internal_client.pool.sentinels:
+            self.selector.register(
+                sentinel, selectors.EVENT_READ, self.internal_client)
+
+        # Wake up now and then even when nothing happens, and with
+        # --stats-dump, at least often enough to dump on time
+        timeout = HOUSEKEEPING_INTERVAL
+        if self.stats_dump:
+            timeout = min(timeout, self.stats_interval)
+        next_dump = time.time() + self.stats_interval
 
-            for client in readable_sockets:
-                if client in self.clients:
-                    self.clients[client].socket_readable_notification()
-                else:
-                    (conn, addr) = client.accept()
+        while True:
+            # Keep going without waiting while initial loads are being sent
+            # or posts indexed
+            if self.internal_client.streams or self.internal_client.unindexed:
+                ready = self.selector.select(0)
+            else:
+                ready = self.selector.select(timeout)
+            started = time.monotonic()
+            # Posts sent before this round, whose lines have been written
+            # by the end of it
+            unindexed = len(self.internal_client.unindexed)
+            self.metrics.observe('loop_events', len(ready), SIZE_BUCKETS)
+
+            for key, events in ready:
+                if key.data is self.internal_client:
+                    if key.fileobj is self.internal_client.response_queue:
+                        self.internal_client.loop_hook()
+                    else:
+                        self.internal_client.reap_workers()
+
+                elif key.data is None:
+                    (conn, addr) = key.fileobj.accept()
                     if self.ssl_pem_file:
                         conn = self._maybe_wrap_ssl(conn, addr)
                     if not conn:
                         continue
-                    self.clients[conn] = Client(self, conn)
+                    client = Client(self, conn)
+                    self.clients[conn] = client
+                    self.selector.register(conn, selectors.EVENT_READ, client)
                     logger.info("Accepted connection from %s:%s.",
                                 addr[0], addr[1])
 
-            for client in writable_sockets:
-                if client in self.clients:  # client may have been disconnected
-                    self.clients[client].socket_writable_notification()
+                else:
+                    client = key.data
+                    # The client may have been disconnected while handling
+                    # an earlier event
+                    if events & selectors.EVENT_READ \
+                            and self.clients.get(client.socket) is client:
+                        client.socket_readable_notification()
+                    if events & selectors.EVENT_WRITE \
+                            and self.clients.get(client.socket) is client:
+                        client.socket_writable_notification()
+
+            # Between rounds, so sockets are written in between chunks
+            if self.internal_client.streams:
+                self.internal_client.stream_loads()
+
+            if unindexed:
+                self.internal_client.index_posts(unindexed)
+
+            while self.pending_disconnects:
+                client, quitmsg = self.pending_disconnects.pop()
+                if self.clients.get(client.socket) is client:
+                    client.disconnect(quitmsg)
 
             now = time.time()
-            if self.last_aliveness_check + 10 < now:
+            if self.last_aliveness_check + HOUSEKEEPING_INTERVAL < now:
                 for client in list(self.clients.values()):
                     client.check_aliveness()
+                self.internal_client.expire_subscriptions()
                 self.last_aliveness_check = now
 
+            if self.stats_dump and now >= next_dump:
+                dump(self.stats(), self.stats_dump)
+                next_dump = now + self.stats_interval
+
+            self.metrics.observe('loop_time', time.monotonic() - started)
+
     def _maybe_wrap_ssl(self, conn, addr):
         try:
             return ssl.wrap_socket(
@@ -262,7 +387,8 @@ def parse_options(argv):
     op.add_option(
         "--statedir",
         metavar="X",
-        help="save persistent channel state (topic, key) in directory X")
+        help="save persistent channel state (topic, key) and followed"
+             " boards and threads in directory X")
     op.add_option(
         "--verbose",
         action="store_true",
@@ -279,9 +405,84 @@ def parse_options(argv):
             help="change process user (and optionally group) after startup"
                  " (requires root)")
 
+    op.add_option(
+        "--sendq",
+        metavar="X",
+        type="int",
+        default=WRITE_BUFFER_HIGH_WATER,
+        help="disconnect clients with more than X bytes of unsent output;"
+             " default: %d" % WRITE_BUFFER_HIGH_WATER)
+    op.add_option(
+        "--api-base",
+        metavar="X",
+        default=API_BASE,
+        help="fetch from the 4chan API at URL X; default: %s" % API_BASE)
+    op.add_option(
+        "--api-rate",
+        metavar="X",
+        type="float",
+        default=API_RATE,
+        help="make at most X 4chan API requests per second; default: %s"
+             % API_RATE)
+    op.add_option(
+        "--api-burst",
+        metavar="X",
+        type="int",
+        default=API_BURST,
+        help="allow bursts of up to X API requests; default: %s"
+             % API_BURST)
+    op.add_option(
+        "--api-workers",
+        metavar="X",
+        type="int",
+        default=API_WORKERS,
+        help="spread followed boards over X API worker processes;"
+             " default: %s" % API_WORKERS)
+    op.add_option(
+        "--engine",
+        metavar="X",
+        type="choice",
+        choices=ENGINES,
+        default=ENGINES[0],
+        help="run API workers as X, one of %s; asyncio needs aiohttp;"
+             " default: %s" % (", ".join(ENGINES), ENGINES[0]))
+    op.add_option(
+        "--initial-posts",
+        metavar="X",
+        type="int",
+        default=0,
+        help="on joining a board or thread, send its X newest threads or"
+             " posts first and the older ones after them; default: send"
+             " everything oldest first")
+    op.add_option(
+        "--unfollow-grace",
+        metavar="X",
+        type="float",
+        default=UNFOLLOW_GRACE,
+        help="stop following boards and threads X seconds after their last"
+             " watcher leaves; default: %s" % UNFOLLOW_GRACE)
+    op.add_option(
+        "--stats-dump",
+        metavar="X",
+        help="periodically write runtime stats as JSON to file X, or to"
+             " the unix socket at path P with X = unix:P")
+    op.add_option(
+        "--stats-interval",
+        metavar="X",
+        type="float",
+        default=STATS_INTERVAL,
+        help="dump stats every X seconds with --stats-dump; default: %s"
+             % STATS_INTERVAL)
+
     (options, args) = op.parse_args(argv[1:])
     if options.debug:
         options.verbose = True
+    if options.api_workers < 1:
+        op.error("--api-workers must be at least 1")
+    if options.initial_posts < 0:
+        op.error("--initial-posts can't be negative")
+    if options.stats_interval <= 0:
+        op.error("--stats-interval must be positive")
     if options.ports is None:
         if options.ssl_pem_file is None:
             options.ports = "6667"
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import time
+
+from futami.common import BoardTarget
+
+# Most posts kept in a subscription's snapshot. Boards list around 150
+# threads, and threads rarely go much past their bump limit.
+SNAPSHOT_SIZE = 1000
+
+# Most lines, and bytes of them, kept in a subscription's scrollback
+SCROLLBACK_LINES = 500
+SCROLLBACK_BYTES = 2 ** 18
+
+
+class Subscription(object):
+    """Everyone watching one board or thread, a snapshot of the posts
+    delivered for it so far, and a scrollback of the lines they were sent
+    as, so that late joiners can be caught up without another API request.
+
+    Each scrollback line is numbered. Watchers who leave are remembered by
+    nickname with the number of the last line they were sent, and are only
+    sent what came after it when they come back. On boards, the line an OP
+    was last sent as supersedes any earlier one, so the scrollback holds one
+    line per thread, in bump order.
+
+    The target is fetched and followed once, when its first watcher joins,
+    and is unfollowed once it has had no watchers for a while.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.watchers = []
+        # When the last watcher left, or None while there are watchers
+        self.idle_since = time.time()
+        # post_no => Post. Boards keep the latest version of each OP,
+        # ordered by when it was last bumped.
+        self.snapshot = OrderedDict()
+        # line number => (line number, encoded line) of the latest lines
+        # sent, or on boards, post_no => (line number, encoded line) of the
+        # line each OP was last sent as
+        self.scrollback = OrderedDict()
+        self.scrollback_size = 0
+        self.lines = 0
+        # Number of the latest line dropped from the scrollback for space
+        self.evicted = 0
+        # nickname => number of the last line sent before they left
+        self.cursors = {}
+
+    @property
+    def is_board(self):
+        return isinstance(self.target, BoardTarget)
+
+    @property
+    def channel(self):
+        if self.is_board:
+            return "#/{}/".format(self.target.board)
+        return "#/{}/{}".format(self.target.board, self.target.thread)
+
+    def add_watcher(self, client):
+        self.watchers.append(client)
+        self.idle_since = None
+
+    def remove_watcher(self, client):
+        if client in self.watchers:
+            self.watchers.remove(client)
+            if not self.watchers:
+                self.idle_since = time.time()
+
+            # Cursors from before lines that have been dropped are no use
+            for nickname, cursor in list(self.cursors.items()):
+                if cursor < self.evicted:
+                    del self.cursors[nickname]
+            self.cursors[client.nickname] = self.lines
+
+    def add_line(self, line, post_no=None):
+        """Keep a line sent to the watchers in the scrollback, along with
+        the number of the post it was sent for, if any.
+        """
+        self.lines += 1
+        key = self.lines
+        if self.is_board and post_no is not None:
+            key = post_no
+            superseded = self.scrollback.pop(key, None)
+            if superseded is not None:
+                self.scrollback_size -= len(superseded[1])
+
+        self.scrollback[key] = (self.lines, line)
+        self.scrollback_size += len(line)
+        while len(self.scrollback) > SCROLLBACK_LINES \
+                or self.scrollback_size > SCROLLBACK_BYTES:
+            _, (self.evicted, dropped) = self.scrollback.popitem(last=False)
+            self.scrollback_size -= len(dropped)
+
+    def replay(self, client):
+        """Return the scrollback lines a joining client hasn't been sent."""
+        cursor = self.cursors.pop(client.nickname, 0)
+        return [line for number, line in self.scrollback.values() if number > cursor]
+
+    def remember(self, post):
+        self.snapshot.pop(post.post_no, None)
+        self.snapshot[post.post_no] = post
+        if len(self.snapshot) > SNAPSHOT_SIZE:
+            self.snapshot.popitem(last=False)
+
+    def text(self, post):
+        """What watchers of this target are shown for a post."""
+        if self.is_board:
+            return post.summary
+        return post.comment
+
+    def __repr__(self):
+        return "<{} {} ({} watchers)>".format(
+            self.__class__.__name__, self.channel, len(self.watchers))
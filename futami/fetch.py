@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+from time import (
+    monotonic,
+    sleep,
+)
+import json
+import logging
+
+from requests.adapters import HTTPAdapter
+import requests
+
+from futami.ipc import fork_context
+from futami.metrics import Histogram
+
+# Keep-alive connections held open per host
+POOL_SIZE = 4
+CONNECT_TIMEOUT = 5  # seconds
+READ_TIMEOUT = 15  # seconds
+
+# Sustained API requests per second across all workers, and how many may
+# be made back to back after a quiet period
+API_RATE = 1.0
+API_BURST = 5
+
+# Everything a fetch can fail with once its retries are exhausted
+FETCH_ERRORS = (requests.RequestException, ValueError)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def http_status(exception):
+    """Return the status code of the response a fetch failed on, or None if
+    it failed without one, e.g. on a timeout. Works for the errors of
+    requests and of aiohttp, whose ClientResponseError carries the status
+    itself.
+    """
+    if isinstance(exception, requests.HTTPError):
+        response = exception.response
+        return None if response is None else response.status_code
+    return getattr(exception, 'status', None)
+
+
+def is_transient(exception, errors=FETCH_ERRORS):
+    """Whether a failed fetch is worth retrying. Client errors such as a
+    404 for a pruned thread will not go away by asking again. Fetches made
+    some other way than with requests fail with their own errors.
+    """
+    status = http_status(exception)
+    if status is not None:
+        return status >= 500
+    return isinstance(exception, errors)
+
+
+def is_gone(exception):
+    """Whether a failed fetch means the thing fetched no longer exists,
+    e.g. a thread that was pruned or deleted.
+    """
+    return http_status(exception) == 404
+
+
+def fetch_stats(fetcher):
+    """Return a snapshot of what a Fetcher, or anything keeping the same
+    statistics, has done so far.
+    """
+    stats = {
+        'responses': dict(fetcher.stats),
+        'latency': fetcher.latency.as_dict(),
+        'limiter_wait': fetcher.limiter_wait,
+        'limiter_waits': fetcher.limiter_waits,
+    }
+    return stats
+
+
+class RateLimiter:
+    """Token bucket shared by every process it is handed to before they
+    are started.
+
+    Interactive acquirers, such as initial channel loads, take priority:
+    while one is waiting for a token, background acquirers hold off.
+    """
+
+    def __init__(self, rate=API_RATE, burst=API_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._lock = fork_context.Lock()
+        self._tokens = fork_context.Value('d', burst, lock=False)
+        self._updated = fork_context.Value('d', monotonic(), lock=False)
+        self._interactive_waiting = fork_context.Value('i', 0, lock=False)
+
+    def acquire(self, interactive=False):
+        """Block until a request may be made. Return the seconds waited."""
+        started = monotonic()
+
+        with self.waiting(interactive):
+            wait = self.take(interactive)
+            while wait:
+                sleep(wait)
+                wait = self.take(interactive)
+
+        return monotonic() - started
+
+    @contextmanager
+    def waiting(self, interactive):
+        """Hold off background acquirers for as long as an interactive one
+        is inside this.
+        """
+        if interactive:
+            with self._lock:
+                self._interactive_waiting.value += 1
+        try:
+            yield
+        finally:
+            if interactive:
+                with self._lock:
+                    self._interactive_waiting.value -= 1
+
+    def take(self, interactive=False):
+        """Take a token without blocking. Return 0 if one was taken, or
+        else how many seconds to wait before trying again.
+        """
+        with self._lock:
+            now = monotonic()
+            tokens = self._tokens.value + (now - self._updated.value) * self.rate
+            tokens = min(tokens, self.burst)
+            self._tokens.value = tokens
+            self._updated.value = now
+
+            if tokens >= 1 and (interactive or not self._interactive_waiting.value):
+                self._tokens.value -= 1
+                return 0
+
+            if tokens < 1:
+                return (1 - tokens) / self.rate
+            # Deferring to an interactive acquirer
+            return 1 / self.rate
+
+
+class BaseFetcher:
+    """What fetching JSON documents from the 4chan API involves besides
+    making the request itself, which is up to subclasses.
+
+    The Last-Modified and ETag validators of every response are kept per
+    URL, so that conditional fetches of a resource that hasn't changed
+    come back as a bodyless 304 instead of a full download.
+
+    When given a RateLimiter, every request first waits for a token from
+    it, at interactive priority if the fetcher is interactive.
+    """
+
+    def __init__(self, rate_limiter=None, interactive=False):
+        self.rate_limiter = rate_limiter
+        self.interactive = interactive
+
+        # Dictionary of url => (last_modified, etag) of the last 200
+        self.validators = {}
+        # Counter of HTTP status code => responses received, and how long
+        # they took to arrive
+        self.stats = Counter()
+        self.latency = Histogram()
+        self._stats_lock = Lock()
+        # Total seconds spent waiting on the rate limiter, and how many
+        # requests had to wait at all
+        self.limiter_wait = 0.0
+        self.limiter_waits = 0
+
+    def request_headers(self, url, conditional):
+        """Return the headers to fetch url with, which for a conditional
+        fetch make an unchanged resource come back as a 304.
+        """
+        headers = {}
+        if conditional and url in self.validators:
+            last_modified, etag = self.validators[url]
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+            if etag:
+                headers['If-None-Match'] = etag
+        return headers
+
+    def waited(self, seconds):
+        """Count time spent waiting on the rate limiter."""
+        if seconds:
+            with self._stats_lock:
+                self.limiter_wait += seconds
+                self.limiter_waits += 1
+
+    def received(self, url, status, started):
+        """Count a response to a request for url made at started. Return
+        whether it is a 304.
+        """
+        with self._stats_lock:
+            self.stats[status] += 1
+            self.latency.observe(monotonic() - started)
+
+        if status != 304:
+            return False
+        logger.debug("{} not modified".format(url))
+        return True
+
+    def store(self, url, headers, body):
+        """Take in the headers and body of a successful response, and
+        return the document decoded from it.
+        """
+        self.validators[url] = (
+            headers.get('Last-Modified'),
+            headers.get('ETag'),
+        )
+
+        return json.loads(body.decode('utf-8'))
+
+
+class Fetcher(BaseFetcher):
+    """Fetches JSON documents from the 4chan API with requests.
+
+    Requests go through a pooled keep-alive session, so consecutive
+    fetches reuse the same connection instead of paying for a TCP and TLS
+    handshake every time. A Fetcher may be used from several threads at
+    once, but must not be shared between processes.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, rate_limiter=None, interactive=False):
+        super().__init__(rate_limiter, interactive)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.timeout = (connect_timeout, read_timeout)
+
+    def get_json(self, url, conditional=False):
+        """Return the decoded JSON at url. When conditional is set and the
+        resource is unchanged since it was last fetched, return None.
+        """
+        headers = self.request_headers(url, conditional)
+        if self.rate_limiter:
+            self.waited(self.rate_limiter.acquire(self.interactive))
+
+        started = monotonic()
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if self.received(url, response.status_code, started):
+            return None
+
+        response.raise_for_status()
+        return self.store(url, response.headers, response.content)
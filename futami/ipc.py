@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from collections import (
+    Counter,
+    namedtuple,
+)
+from time import time
+import fcntl
+import logging
+import multiprocessing
+import os
+import pickle
+import struct
+
+from futami.metrics import (
+    SIZE_BUCKETS,
+    Histogram,
+)
+
+# Most bytes taken off the pipe per drain. Pipes rarely buffer more than
+# this, so one read normally empties it.
+READ_SIZE = 2 ** 20
+
+# Each batch goes over the pipe as its length and then its pickle
+_frame_header = struct.Struct('!I')
+
+# Workers inherit raw pipe fds, and Ami instances holding thread locks, so
+# they have to be forked, whatever the default start method is. Everything
+# shared with them comes from this context too.
+fork_context = multiprocessing.get_context('fork')
+
+logger = logging.getLogger(__name__)
+
+ResponseBatch = namedtuple('ResponseBatch', ['sent', 'items'])
+
+
+class BatchQueue:
+    """One-way channel for lists of results, from any number of worker
+    processes to a single reader.
+
+    Each put sends its whole list as one pickle in one write, and the
+    reader takes everything waiting with one read. The reader end is
+    non-blocking, and the queue has a fileno() so it can be waited on with
+    select.
+
+    The reader keeps counts of reads, batches, items and bytes in stats,
+    along with histograms of how long batches took to arrive, and of how
+    many were waiting at once.
+    """
+
+    def __init__(self):
+        self._reader, self._writer = os.pipe()
+        flags = fcntl.fcntl(self._reader, fcntl.F_GETFL)
+        fcntl.fcntl(self._reader, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # Frames bigger than the pipe's atomic write size could otherwise
+        # interleave between writers
+        self._write_lock = fork_context.Lock()
+        self._buffer = bytearray()
+
+        self.stats = Counter()
+        self.latency = Histogram()
+        self.depth = Histogram(SIZE_BUCKETS)
+
+    def fileno(self):
+        return self._reader
+
+    def put(self, items):
+        """Send a list of items as one batch."""
+        data = pickle.dumps(ResponseBatch(time(), items), pickle.HIGHEST_PROTOCOL)
+        frame = memoryview(_frame_header.pack(len(data)) + data)
+        with self._write_lock:
+            while frame:
+                frame = frame[os.write(self._writer, frame):]
+
+    def get_batches(self):
+        """Return every batch that has fully arrived, without blocking."""
+        try:
+            data = os.read(self._reader, READ_SIZE)
+        except BlockingIOError:
+            return []
+        self._buffer += data
+
+        batches = []
+        offset = 0
+        while len(self._buffer) - offset >= _frame_header.size:
+            (length,) = _frame_header.unpack_from(self._buffer, offset)
+            end = offset + _frame_header.size + length
+            if end > len(self._buffer):
+                break
+            batches.append(pickle.loads(self._buffer[offset + _frame_header.size:end]))
+            offset = end
+        del self._buffer[:offset]
+
+        self._record(batches, len(data))
+        return batches
+
+    def _record(self, batches, size):
+        now = time()
+        self.stats['reads'] += 1
+        self.stats['bytes'] += size
+        self.stats['batches'] += len(batches)
+        self.depth.observe(len(batches))
+        for batch in batches:
+            self.stats['items'] += len(batch.items)
+            self.latency.observe(now - batch.sent)
+
+        if batches:
+            logger.debug("read {} batches of {} items in {} bytes, {:.3f}s behind".format(
+                len(batches),
+                sum(len(batch.items) for batch in batches),
+                size,
+                now - batches[0].sent,
+            ))
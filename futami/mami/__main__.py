@@ -0,0 +1,3 @@
+from futami.mami import main
+
+main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+from collections import Counter
+import json
+import logging
+import os
+import socket
+import tempfile
+
+# Histogram bucket upper bounds for durations, in seconds, four to a decade
+# from 100us to 100s, and for sizes and counts, in powers of two
+LATENCY_BUCKETS = tuple(10 ** (exponent / 4) for exponent in range(-16, 9))
+SIZE_BUCKETS = tuple(2 ** exponent for exponent in range(31))
+
+# Prefix of a --stats-dump destination that is a unix socket, not a file
+SOCKET_PREFIX = "unix:"
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Counts of values falling into fixed buckets, cheap enough to record
+    every event into. Quantiles are reported as the upper bound of the
+    bucket they fall in.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is of values past the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], self.max)
+                return self.max
+        return 0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """Named counters and histograms for one component."""
+
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = {}
+
+    def incr(self, name, count=1):
+        self.counters[name] += count
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+    def snapshot(self):
+        snapshot = dict(self.counters)
+        for name, histogram in self.histograms.items():
+            snapshot[name] = histogram.as_dict()
+        return snapshot
+
+
+def flatten(snapshot, prefix=""):
+    """Return a nested snapshot as a sorted list of (dotted key, value)."""
+    items = []
+    for key, value in snapshot.items():
+        key = prefix + str(key).replace(" ", "_")
+        if isinstance(value, dict):
+            items.extend(flatten(value, key + "."))
+        else:
+            items.append((key, value))
+    return sorted(items)
+
+
+def dump(snapshot, destination):
+    """Write a snapshot as a line of JSON to destination, which is either a
+    file path, replaced atomically, or unix:<path> of a listening socket.
+    """
+    data = json.dumps(snapshot, sort_keys=True) + "\n"
+
+    if destination.startswith(SOCKET_PREFIX):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(1)
+        try:
+            sock.connect(destination[len(SOCKET_PREFIX):])
+            sock.sendall(data.encode('utf-8'))
+        except (socket.error, socket.timeout) as e:
+            logger.debug("Could not send stats to %s: %s", destination, e)
+        finally:
+            sock.close()
+        return
+
+    (fd, path) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(destination)))
+    with os.fdopen(fd, "w") as fp:
+        fp.write(data)
+    os.rename(path, destination)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect
+from multiprocessing.connection import wait
+import hashlib
+import logging
+
+from futami.ami import (
+    API_BASE,
+    Ami,
+)
+from futami.common import (
+    Action,
+    SubscriptionUpdate,
+)
+from futami.ipc import fork_context
+
+API_WORKERS = 1
+
+# Names of the ways an Ami worker can run, the first being the default
+ENGINES = ('process', 'asyncio')
+
+# Points each worker gets on the hash ring. More points spread boards more
+# evenly between workers.
+RING_REPLICAS = 64
+
+logger = logging.getLogger(__name__)
+
+
+def engine_class(engine):
+    """Return the Ami class that runs workers with the named engine."""
+    if engine == 'asyncio':
+        # Only needs aiohttp when asked for
+        from futami.aio import AsyncAmi
+        return AsyncAmi
+    return Ami
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class HashRing:
+    """Consistent hash ring, so that removing a node only moves the keys
+    that were on it.
+    """
+
+    def __init__(self, nodes=(), replicas=RING_REPLICAS):
+        self.replicas = replicas
+        # Sorted lists of points, and the node at each
+        self._points = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = _hash("{}-{}".format(node, replica))
+            index = bisect(self._points, point)
+            self._points.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def remove(self, node):
+        for index in reversed(range(len(self._nodes))):
+            if self._nodes[index] == node:
+                del self._points[index]
+                del self._nodes[index]
+
+    def get(self, key):
+        if not self._points:
+            return None
+        index = bisect(self._points, _hash(key)) % len(self._points)
+        return self._nodes[index]
+
+
+class Worker:
+    """One Ami, which is its immediate worker process and the periodic
+    worker that process starts, and the queue of requests for it. The
+    immediate worker exits whenever the periodic one does, so the
+    sentinel of its process covers both.
+    """
+
+    def __init__(self, shard, response_queue, rate_limiter, engine=Ami, api_base=API_BASE):
+        self.shard = shard
+        self.request_queue = fork_context.SimpleQueue()
+        self.process = fork_context.Process(
+            target=engine,
+            name='immediate api worker {}'.format(shard),
+            args=(self.request_queue, response_queue, rate_limiter),
+            kwargs={'shard': shard, 'api_base': api_base},
+        )
+        self.process.start()
+
+    @property
+    def process_names(self):
+        return (
+            self.process.name,
+            'periodic api worker {}'.format(self.shard),
+        )
+
+    def __repr__(self):
+        return "<{} {} (pid {})>".format(self.__class__.__name__, self.shard, self.process.pid)
+
+
+class AmiPool:
+    """A number of Ami workers with boards spread between them, all sending
+    their results to the same response queue.
+
+    Every request for a board, or for any of its threads, goes to the same
+    worker, which polls them in order. When a worker dies its boards are
+    spread over the others.
+    """
+
+    def __init__(self, size, response_queue, rate_limiter=None, engine=ENGINES[0],
+                 api_base=API_BASE):
+        self.workers = {
+            shard: Worker(shard, response_queue, rate_limiter, engine_class(engine), api_base)
+            for shard in range(size)
+        }
+        self.ring = HashRing(self.workers)
+
+    def __len__(self):
+        return len(self.workers)
+
+    def owner(self, target):
+        return self.workers[self.ring.get(target.board)]
+
+    def put(self, request):
+        self.owner(request.target).request_queue.put(request)
+
+    @property
+    def sentinels(self):
+        """Handles that become ready when a worker's process exits."""
+        return [worker.process.sentinel for worker in self.workers.values()]
+
+    def retire(self, process_name):
+        """Stop the worker one of whose processes is called process_name,
+        e.g. after it sent back an exception. Its periodic worker stops
+        too.
+
+        The worker is asked to shut down rather than killed, as it may be
+        halfway through writing to the response queue, holding the lock
+        every worker writes under.
+        """
+        for worker in self.workers.values():
+            if process_name in worker.process_names:
+                logger.error("retiring {}".format(worker))
+                worker.request_queue.put(SubscriptionUpdate.make(
+                    action=Action.Shutdown,
+                    target=None,
+                ))
+
+    def reap(self):
+        """Take dead workers out of the pool and return them."""
+        # The server may have daemonized since the workers were started, in
+        # which case they are no longer its children and can't be waited
+        # for, but their sentinels still work
+        exited = set(wait(self.sentinels, timeout=0))
+        dead = [
+            worker for worker in self.workers.values()
+            if worker.process.sentinel in exited
+        ]
+        for worker in dead:
+            logger.error("{} has exited".format(worker))
+            del self.workers[worker.shard]
+            self.ring.remove(worker.shard)
+        return dead
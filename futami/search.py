@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+from collections import (
+    Counter,
+    OrderedDict,
+    defaultdict,
+    namedtuple,
+)
+from math import log
+from time import time
+import re
+
+SEARCH_POSTS = 100000
+SEARCH_AGE = 24 * 60 * 60  # seconds
+SEARCH_RESULTS = 10
+
+# Longest snippet of a post kept to show in results
+SNIPPET_LENGTH = 120
+
+# IRC bold, colour, reset, reverse, italic and underline codes, as left in
+# by clean_comment
+_formatting_regexp = re.compile(r"\x03(?:\d{1,2}(?:,\d{1,2})?)?|[\x02\x0f\x16\x1d\x1f]")
+_word_regexp = re.compile(r"\w+")
+
+IndexedPost = namedtuple('IndexedPost', ['board', 'thread', 'post_no', 'added', 'terms', 'snippet'])
+
+SearchResult = namedtuple('SearchResult', ['score', 'post'])
+
+
+def terms(text):
+    """Return the lowercased words of cleaned post text."""
+    return _word_regexp.findall(_formatting_regexp.sub(" ", text).lower())
+
+
+class SearchIndex:
+    """Inverted index over the text of recently delivered posts.
+
+    Posts are added one at a time as they go by, and are evicted once they
+    are older than max_age or there are more than max_posts of them, oldest
+    first. A post added again, such as a bumped OP, replaces its earlier
+    version and counts as new.
+
+    Queries match posts containing every one of their words, ranked by
+    TF-IDF, and then newest first.
+    """
+
+    def __init__(self, max_posts=SEARCH_POSTS, max_age=SEARCH_AGE):
+        self.max_posts = max_posts
+        self.max_age = max_age
+
+        # (board, post_no) => IndexedPost, oldest first
+        self._posts = OrderedDict()
+        # term => {(board, post_no) => occurrences}
+        self._postings = defaultdict(dict)
+
+    def __len__(self):
+        return len(self._posts)
+
+    def add(self, post, now=None):
+        if now is None:
+            now = time()
+        key = (post.board, post.post_no)
+        self._remove(key)
+
+        text = post.text or ""
+        if post.subject:
+            text = post.clean(post.subject) + " " + text
+        counts = Counter(terms(text))
+        if not counts:
+            return
+
+        snippet = _formatting_regexp.sub("", text)[:SNIPPET_LENGTH]
+        self._posts[key] = IndexedPost(
+            post.board,
+            post.reply_to or post.post_no,
+            post.post_no,
+            now,
+            counts,
+            snippet,
+        )
+        for term, count in counts.items():
+            self._postings[term][key] = count
+
+        self._evict(now)
+
+    def _remove(self, key):
+        indexed = self._posts.pop(key, None)
+        if indexed is None:
+            return
+        for term in indexed.terms:
+            postings = self._postings[term]
+            del postings[key]
+            if not postings:
+                del self._postings[term]
+
+    def _evict(self, now):
+        while self._posts:
+            key, oldest = next(iter(self._posts.items()))
+            if len(self._posts) <= self.max_posts and oldest.added >= now - self.max_age:
+                break
+            self._remove(key)
+
+    def search(self, query, board=None, thread=None, limit=SEARCH_RESULTS):
+        """Return up to limit SearchResults for the posts matching every
+        word of query, optionally only those on board, or in thread of
+        board.
+        """
+        self._evict(time())
+
+        words = set(terms(query))
+        if not words:
+            return []
+        # The rarest word narrows the candidates down the most
+        postings = sorted((self._postings.get(word, {}) for word in words), key=len)
+        candidates = [
+            key for key in postings[0]
+            if all(key in other for other in postings[1:])
+        ]
+
+        results = []
+        for key in candidates:
+            indexed = self._posts[key]
+            if board is not None and indexed.board != board:
+                continue
+            if thread is not None and indexed.thread != thread:
+                continue
+            score = sum(
+                indexed.terms[word] * log(1 + len(self._posts) / len(self._postings[word]))
+                for word in words
+            )
+            results.append(SearchResult(score, indexed))
+
+        results.sort(key=lambda result: (result.score, result.post.added), reverse=True)
+        return results[:limit]
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import tempfile
+
+from futami.common import (
+    BoardTarget,
+    ThreadTarget,
+)
+
+JOURNAL_NAME = "subscriptions.journal"
+
+# The journal is rewritten from the live state once it holds this many
+# times as many records as the live state needs, and at least
+# COMPACT_MIN_RECORDS of them.
+COMPACT_RATIO = 4
+COMPACT_MIN_RECORDS = 10000
+
+logger = logging.getLogger(__name__)
+
+
+def _target_key(target):
+    if isinstance(target, BoardTarget):
+        return [target.board, None]
+    return [target.board, target.thread]
+
+
+def _key_target(board, thread):
+    if thread is None:
+        return BoardTarget(board)
+    return ThreadTarget(board, thread)
+
+
+class StateStore:
+    """Append-only journal of followed targets and the posts delivered for
+    them, kept in a state directory so that a restarted bridge can pick up
+    where it left off.
+
+    Each line is one compact JSON record:
+
+        ["follow", board, thread]
+        ["post", board, thread, post data]
+        ["unfollow", board, thread]
+
+    where thread is null for boards and post data is in the API's format.
+    A record cut short by a crash is dropped when the journal is loaded.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(os.path.abspath(directory), JOURNAL_NAME)
+        self._journal = None
+        self._records = 0
+
+    def load(self):
+        """Return an ordered dictionary of every target in the journal, in
+        the order they were first followed, to a list of post data in the
+        order it was recorded.
+        """
+        targets = OrderedDict()
+        self._records = 0
+
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as journal:
+                for line_no, line in enumerate(journal, 1):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning("ignoring damaged record at {}:{}".format(self.path, line_no))
+                        continue
+
+                    kind, board, thread = record[:3]
+                    target = _key_target(board, thread)
+                    if kind == 'unfollow':
+                        targets.pop(target, None)
+                    else:
+                        posts = targets.setdefault(target, [])
+                        if kind == 'post':
+                            posts.append(record[3])
+                    self._records += 1
+
+        logger.info("loaded {} targets from {}".format(len(targets), self.path))
+        return targets
+
+    def follow(self, target):
+        self._append(['follow'] + _target_key(target))
+
+    def unfollow(self, target):
+        self._append(['unfollow'] + _target_key(target))
+
+    def record(self, target, post):
+        self._append(['post'] + _target_key(target) + [post.to_data()])
+
+    def flush(self):
+        if self._journal is not None:
+            self._journal.flush()
+
+    def _append(self, record):
+        if self._journal is None:
+            self._journal = open(self.path, 'a', encoding='utf-8')
+        self._journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._records += 1
+
+    def maybe_compact(self, subscriptions):
+        """Rewrite the journal from subscriptions, a dictionary of target =>
+        Subscription, if it has grown well past what they need.
+        """
+        live = sum(1 + len(subscription.snapshot) for subscription in subscriptions.values())
+        if self._records < max(live * COMPACT_RATIO, COMPACT_MIN_RECORDS):
+            return
+        self.compact(subscriptions)
+
+    def compact(self, subscriptions):
+        logger.info("compacting {} ({} records)".format(self.path, self._records))
+
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+        (fd, path) = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        self._journal = os.fdopen(fd, 'w', encoding='utf-8')
+        self._records = 0
+        for target, subscription in subscriptions.items():
+            self.follow(target)
+            for post in subscription.snapshot.values():
+                self.record(target, post)
+        self._journal.close()
+        self._journal = None
+
+        os.rename(path, self.path)
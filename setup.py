@@ -22,6 +22,9 @@ setup(
         'requests==2.6.0',
         'retrying==1.3.3',
     ],
+    extras_require={
+        'asyncio': ['aiohttp'],
+    },
     tests_require=[
         'pep8==1.6.2',
         'pyflakes==0.8.1',
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+from nose.tools import assert_equal
+
+from futami.ami import (
+    ThreadIndex,
+    ThreadListing,
+    is_archived,
+)
+from futami.common import (
+    BoardTarget,
+    Post,
+    ThreadTarget,
+)
+
+
+def listing(**threads):
+    return [
+        {'no': int(no[1:]), 'last_modified': last_modified}
+        for no, last_modified in threads.items()
+    ]
+
+
+class TestThreadIndex(object):
+    def test_fetches_only_changed_threads(self):
+        index = ThreadIndex()
+        index.follow(ThreadTarget('g', 1))
+        index.follow(ThreadTarget('g', 2))
+
+        assert_equal(
+            index.update('g', listing(t1=10, t2=10, t3=10)),
+            ([(ThreadTarget('g', 1), 10), (ThreadTarget('g', 2), 10)], []),
+        )
+        index.fetched(ThreadTarget('g', 1), 10)
+        index.fetched(ThreadTarget('g', 2), 10)
+
+        assert_equal(index.update('g', listing(t1=10, t2=20, t3=30)), ([(ThreadTarget('g', 2), 20)], []))
+        index.fetched(ThreadTarget('g', 2), 20)
+        assert_equal(index.update('g', None), ([], []))
+
+    def test_failed_fetches_are_fetched_again(self):
+        index = ThreadIndex()
+        index.follow(ThreadTarget('g', 1))
+        assert_equal(index.update('g', listing(t1=10)), ([(ThreadTarget('g', 1), 10)], []))
+
+        # The listing is unchanged, but the thread was never fetched
+        assert_equal(index.update('g', None), ([(ThreadTarget('g', 1), 10)], []))
+
+    def test_threads_off_the_listing_are_missing(self):
+        index = ThreadIndex()
+        index.follow(ThreadTarget('g', 1))
+        index.update('g', listing(t1=10))
+        index.fetched(ThreadTarget('g', 1), 10)
+
+        # Not from an unchanged listing, which may predate the thread
+        index.follow(ThreadTarget('g', 2))
+        assert_equal(index.update('g', None), ([], []))
+
+        assert_equal(index.update('g', listing(t1=10)), ([], [ThreadTarget('g', 2)]))
+        # Still followed until a fetch tells it is gone
+        assert_equal(index.update('g', listing(t1=10)), ([], [ThreadTarget('g', 2)]))
+        assert_equal(index.drop(ThreadTarget('g', 2)), False)
+        assert_equal(index.drop(ThreadTarget('g', 1)), True)
+
+    def test_listing_is_not_a_board(self):
+        assert ThreadListing('g') != BoardTarget('g')
+        assert_equal(len({ThreadListing('g'), BoardTarget('g')}), 2)
+
+
+def test_archived_threads():
+    op = {'no': 1, 'resto': 0, 'board': 'g'}
+    assert not is_archived([])
+    assert not is_archived([Post(op)])
+    assert is_archived([Post(dict(op, archived=1))])
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+from html import unescape
+import re
+
+from nose.tools import assert_equal
+
+from futami.common import Post, clean_comment
+
+
+# The original one-substitution-per-rule cleaner, kept as the reference the
+# single-pass cleaner has to agree with. Its bold and quote rules used
+# '\x02\1\x02' style replacements, where '\1' is chr(1) rather than a group
+# reference and wiped out the text; the reference uses the group.
+LEGACY_RULES = [
+    (r'\[(banned|moot)\]', r'[\1:lit]'),
+    (r'<pre [^>]*>', r'[code]'),
+    (r'</pre>', r'[/code]'),
+    (r'<span class="abbr">.*?</span>', r''),
+    (r'<(?:b|strong) style="color:\s*red;">(.*?)</(?:b|strong)>', '\x0304\\1\x0f[/banned]'),
+    (r'<div style="padding: 5px;margin-left: \.5em;border-color: #faa;border: 2px dashed rgba\(255,0,0,\.1\);border-radius: 2px">(.*?)</div>', r'[moot]\1[/moot]'),
+    (r'<(?:b|strong)>(.*?)</(?:b|strong)>', '\x02\\1\x02'),
+    (r'<font class="unkfunc">(.*?)</font>', '\x0303\\1\x0f'),
+    (r'<span class="quote">(.*?)</span>', '\x0303\\1\x0f'),
+    (r'<span class="(?:[^"]*)?deadlink">(.*?)</span>', '\x0303\\1\x0f'),
+    (r'<a[^>]*>(.*?)</a>', r'\1'),
+    (r'<span class="spoiler"[^>]*>', '\x0301,01'),
+    (r'</span>', '\x0f'),
+    (r'<s>', '\x0301,01'),
+    (r'</s>', '\x0f'),
+    (r'<wbr>', ''),
+    (r'<br>', ' '),
+]
+
+
+def legacy_clean(text):
+    if not text:
+        return text
+    for pattern, replacement in LEGACY_RULES:
+        text = re.sub(pattern, replacement, text)
+    return unescape(text)
+
+
+GOLDEN = [
+    ('', ''),
+    (None, None),
+    ('plain text', 'plain text'),
+    ('line one<br>line two<br><br>line four',
+     'line one line two  line four'),
+    ('<a href="#p12345" class="quotelink">&gt;&gt;12345</a><br>this',
+     '>>12345 this'),
+    ('<span class="quote">&gt;implying</span><br>nice',
+     '\x0303>implying\x0f nice'),
+    ('<span class="quote">&gt;<a href="/g/" class="quotelink">&gt;&gt;/g/</a></span>',
+     '\x0303>>>/g/\x0f'),
+    ('<span class="deadlink">&gt;&gt;999</span>', '\x0303>>999\x0f'),
+    ('<span class="quote deadlink">&gt;&gt;998</span>', '\x0303>>998\x0f'),
+    ('<font class="unkfunc">&gt;old style</font>', '\x0303>old style\x0f'),
+    ('<s>spoiled</s> and <span class="spoiler">also</span>',
+     '\x0301,01spoiled\x0f and \x0301,01also\x0f'),
+    ('<span class="quote">&gt;it was <s>him</s></span>',
+     '\x0303>it was \x0301,01him\x0f\x0f'),
+    ('<span class="quote">&gt;implying <span class="deadlink">&gt;&gt;123</span></span>',
+     '\x0303>implying \x0303>>123\x0f\x0f'),
+    ('<b>bold</b> and <strong>strong</strong>',
+     '\x02bold\x02 and \x02strong\x02'),
+    ('text<br><br><b style="color:red;">(USER WAS BANNED FOR THIS POST)</b>',
+     'text  \x0304(USER WAS BANNED FOR THIS POST)\x0f[/banned]'),
+    ('<pre class="prettyprint">int main() {<br>}</pre>',
+     '[code]int main() { }[/code]'),
+    ('[banned]not really[/banned] [moot]',
+     '[banned:lit]not really[/banned] [moot:lit]'),
+    ('long<br><span class="abbr">Comment too long. <a href="x">Click here</a> to view the full text.</span>',
+     'long '),
+    ('https://example.com/a<wbr>b<wbr>c', 'https://example.com/abc'),
+    ('&quot;quoted&quot; &amp; &#039;escaped&#039;',
+     '"quoted" & \'escaped\''),
+]
+
+
+class TestCleanComment(object):
+    def test_golden_output(self):
+        for text, expected in GOLDEN:
+            assert_equal(clean_comment(text), expected)
+
+    def test_matches_legacy_rules(self):
+        for text, _ in GOLDEN:
+            assert_equal(clean_comment(text), legacy_clean(text))
+
+    def test_text_is_memoized(self):
+        post = Post({'no': 1, 'resto': 0, 'com': '<b>hi</b>', 'board': 'g'})
+        assert_equal(post.comment, '\x02hi\x02')
+        post.raw_comment = 'changed'
+        assert_equal(post.summary, '\x02hi\x02')
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+
+from nose.tools import assert_equal
+
+from futami.metrics import (
+    SIZE_BUCKETS,
+    Histogram,
+    flatten,
+)
+
+
+class TestHistogram(object):
+    def test_quantiles_are_bucket_bounds(self):
+        histogram = Histogram(SIZE_BUCKETS)
+        for value in [1, 1, 3, 3, 3, 3, 3, 3, 3, 100]:
+            histogram.observe(value)
+
+        assert_equal(histogram.quantile(0.5), 4)
+        assert_equal(histogram.quantile(0.99), 100)
+        assert_equal(histogram.as_dict()['mean'], 12.3)
+
+    def test_empty(self):
+        assert_equal(Histogram().as_dict()['p50'], 0)
+
+
+def test_flatten():
+    assert_equal(
+        flatten({'b': 1, 'a': {'some worker': {200: 3}}}),
+        [('a.some_worker.200', 3), ('b', 1)],
+    )
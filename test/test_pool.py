@@ -0,0 +1,28 @@
+#!/usr/bin/python
+
+from nose.tools import assert_equal
+
+from futami.pool import HashRing
+
+
+BOARDS = ['a', 'b', 'c', 'co', 'g', 'jp', 'k', 'm', 'mu', 'tg', 'tv', 'v', 'vg', 'vr']
+
+
+class TestHashRing(object):
+    def test_keys_spread_over_nodes(self):
+        ring = HashRing(range(3))
+        assert_equal({ring.get(board) for board in BOARDS}, {0, 1, 2})
+
+    def test_removing_node_only_moves_its_keys(self):
+        ring = HashRing(range(4))
+        before = {board: ring.get(board) for board in BOARDS}
+
+        ring.remove(2)
+        for board in BOARDS:
+            if before[board] == 2:
+                assert ring.get(board) != 2
+            else:
+                assert_equal(ring.get(board), before[board])
+
+    def test_empty_ring(self):
+        assert_equal(HashRing().get('g'), None)
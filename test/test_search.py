@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+from nose.tools import assert_equal
+
+from futami.common import Post
+from futami.search import (
+    SearchIndex,
+    terms,
+)
+
+
+def post(no, comment, resto=100, board='g'):
+    return Post({'no': no, 'resto': resto, 'com': comment, 'board': board})
+
+
+class TestSearchIndex(object):
+    def test_terms_skip_formatting(self):
+        assert_equal(terms('\x0303>implying\x0f \x02Rust\x02 is fast'), ['implying', 'rust', 'is', 'fast'])
+
+    def test_matches_every_word_ranked(self):
+        index = SearchIndex()
+        index.add(post(101, 'rust is fast'))
+        index.add(post(102, 'rust rust rust is fast'))
+        index.add(post(103, 'python is slow'))
+        index.add(post(201, 'rust is fast', resto=200))
+        index.add(post(301, 'rust is fast', board='v'))
+
+        results = index.search('Fast rust', board='g', thread=100)
+        assert_equal([result.post.post_no for result in results], [102, 101])
+        assert_equal(len(index.search('rust')), 4)
+        assert_equal(index.search('rust slow'), [])
+
+    def test_evicts_oldest(self):
+        index = SearchIndex(max_posts=2, max_age=60)
+        index.add(post(101, 'one'), now=0)
+        index.add(post(102, 'two'), now=10)
+        index.add(post(103, 'three'), now=20)
+        assert_equal(len(index), 2)
+        assert_equal(index.search('one'), [])
+
+        index.add(post(104, 'four'), now=75)
+        assert_equal(len(index), 1)
+
+    def test_readding_replaces(self):
+        index = SearchIndex()
+        index.add(post(100, 'old text', resto=0))
+        index.add(post(100, 'new text', resto=0))
+        assert_equal(len(index), 1)
+        assert_equal(index.search('old'), [])
+        assert_equal(index.search('new', thread=100)[0].post.snippet, 'new text')
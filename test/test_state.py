@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+from tempfile import TemporaryDirectory
+
+from nose.tools import assert_equal
+
+from futami.common import (
+    BoardTarget,
+    Post,
+    ThreadTarget,
+)
+from futami.external.subscription import Subscription
+from futami.state import StateStore
+
+
+OP = {'no': 100, 'resto': 0, 'com': 'op', 'board': 'g', 'last_modified': 1500}
+REPLY = {'no': 101, 'resto': 100, 'com': 'reply', 'board': 'g',
+         'filename': 'a', 'tim': 1420070400000, 'ext': '.png', 'fsize': 1,
+         'md5': 'x', 'w': 1, 'h': 1, 'tn_w': 1, 'tn_h': 1}
+
+
+class TestStateStore(object):
+    def test_load_replays_journal(self):
+        with TemporaryDirectory() as directory:
+            store = StateStore(directory)
+            board = BoardTarget('g')
+            thread = ThreadTarget('g', 100)
+            store.follow(board)
+            store.follow(thread)
+            store.record(board, Post(OP))
+            store.record(thread, Post(OP))
+            store.record(thread, Post(REPLY))
+            store.flush()
+
+            targets = StateStore(directory).load()
+            assert_equal(list(targets), [board, thread])
+            assert_equal(targets[board], [OP])
+            assert_equal(targets[thread], [OP, REPLY])
+
+    def test_damaged_record_is_skipped(self):
+        with TemporaryDirectory() as directory:
+            store = StateStore(directory)
+            target = ThreadTarget('g', 100)
+            store.follow(target)
+            store.record(target, Post(REPLY))
+            store.flush()
+            # As left by a crash part way through a write
+            with open(store.path, 'a') as journal:
+                journal.write('["post","g",100,{"no":1')
+
+            targets = StateStore(directory).load()
+            assert_equal(targets[target], [REPLY])
+
+    def test_compact_keeps_only_snapshots(self):
+        with TemporaryDirectory() as directory:
+            store = StateStore(directory)
+            target = ThreadTarget('g', 100)
+            subscription = Subscription(target)
+            store.follow(target)
+            for _ in range(3):
+                post = Post(REPLY)
+                subscription.remember(post)
+                store.record(target, post)
+
+            store.compact({target: subscription})
+            with open(store.path) as journal:
+                assert_equal(len(journal.readlines()), 2)
+            assert_equal(StateStore(directory).load()[target], [REPLY])
+
+    def test_unfollow_drops_target(self):
+        with TemporaryDirectory() as directory:
+            store = StateStore(directory)
+            board = BoardTarget('g')
+            thread = ThreadTarget('g', 100)
+            store.follow(board)
+            store.follow(thread)
+            store.record(thread, Post(REPLY))
+            store.unfollow(thread)
+            store.flush()
+
+            assert_equal(list(StateStore(directory).load()), [board])
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+
+from nose.tools import assert_equal
+
+from futami.common import (
+    BoardTarget,
+    ThreadTarget,
+)
+from futami.external import subscription as subscription_module
+from futami.external.subscription import Subscription
+
+
+class Watcher(object):
+    def __init__(self, nickname):
+        self.nickname = nickname
+
+
+class TestScrollback(object):
+    def test_bounded_by_lines_and_bytes(self):
+        subscription = Subscription(ThreadTarget('g', 100))
+        for number in range(subscription_module.SCROLLBACK_LINES + 10):
+            subscription.add_line(b'line %d\r\n' % number)
+        assert_equal(len(subscription.scrollback), subscription_module.SCROLLBACK_LINES)
+        assert_equal(subscription.replay(Watcher('apa'))[0], b'line 10\r\n')
+
+        subscription.add_line(b'x' * subscription_module.SCROLLBACK_BYTES)
+        assert_equal(len(subscription.scrollback), 1)
+
+    def test_rejoining_watcher_gets_only_what_they_missed(self):
+        subscription = Subscription(ThreadTarget('g', 100))
+        watcher = Watcher('apa')
+        subscription.add_line(b'one\r\n')
+
+        assert_equal(subscription.replay(watcher), [b'one\r\n'])
+        subscription.add_watcher(watcher)
+        subscription.add_line(b'two\r\n')
+        subscription.remove_watcher(watcher)
+        subscription.add_line(b'three\r\n')
+
+        assert_equal(subscription.replay(watcher), [b'three\r\n'])
+        assert_equal(subscription.replay(Watcher('lemur')), [b'one\r\n', b'two\r\n', b'three\r\n'])
+
+    def test_board_keeps_the_latest_line_of_each_op(self):
+        subscription = Subscription(BoardTarget('g'))
+        watcher = Watcher('apa')
+        subscription.add_line(b'100\r\n', 100)
+        subscription.add_line(b'200\r\n', 200)
+        subscription.add_watcher(watcher)
+        subscription.remove_watcher(watcher)
+        subscription.add_line(b'100 bumped\r\n', 100)
+
+        assert_equal(subscription.replay(watcher), [b'100 bumped\r\n'])
+        assert_equal(subscription.replay(Watcher('lemur')), [b'200\r\n', b'100 bumped\r\n'])